@@ -0,0 +1,34 @@
+"""add referral indexes
+
+Revision ID: 7f3a2c91d4e5
+Revises: 4c986a85169f
+Create Date: 2026-10-18 12:04:51.318402
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7f3a2c91d4e5'
+down_revision: Union[str, None] = '4c986a85169f'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Built concurrently so that registrations are not blocked
+    # while the user table is indexed
+    with op.get_context().autocommit_block():
+        op.create_index('ix_user_referral_name_id', 'user', ['referral_name', 'id'], unique=False, postgresql_include=['username'], postgresql_concurrently=True)
+        op.create_index('ix_user_email_lower', 'user', [sa.text('lower(email)')], unique=False, postgresql_concurrently=True)
+        op.create_index(op.f('ix_referral_expires_at'), 'referral', ['expires_at'], unique=False, postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index(op.f('ix_referral_expires_at'), table_name='referral', postgresql_concurrently=True)
+        op.drop_index('ix_user_email_lower', table_name='user', postgresql_concurrently=True)
+        op.drop_index('ix_user_referral_name_id', table_name='user', postgresql_concurrently=True)
@@ -0,0 +1,45 @@
+"""add referral stats
+
+Revision ID: c4e81b6f20a7
+Revises: 7f3a2c91d4e5
+Create Date: 2026-10-18 17:12:40.583117
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c4e81b6f20a7'
+down_revision: Union[str, None] = '7f3a2c91d4e5'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Filled by `python -m stakewolle.referral_stats` after upgrading
+    op.create_table('referral_stats',
+    sa.Column('referrer_id', sa.Integer(), nullable=False),
+    sa.Column('total', sa.Integer(), nullable=False),
+    sa.Column('last_signup_at', sa.DateTime(timezone=True), nullable=True),
+    sa.ForeignKeyConstraint(['referrer_id'], ['user.id'], ondelete='cascade'),
+    sa.PrimaryKeyConstraint('referrer_id')
+    )
+    op.create_index('ix_referral_stats_total', 'referral_stats', ['total', 'referrer_id'], unique=False)
+    op.create_table('referral_stats_hourly',
+    sa.Column('referrer_id', sa.Integer(), nullable=False),
+    sa.Column('hour', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['referrer_id'], ['user.id'], ondelete='cascade'),
+    sa.PrimaryKeyConstraint('referrer_id', 'hour')
+    )
+    op.create_index(op.f('ix_referral_stats_hourly_hour'), 'referral_stats_hourly', ['hour'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_referral_stats_hourly_hour'), table_name='referral_stats_hourly')
+    op.drop_table('referral_stats_hourly')
+    op.drop_index('ix_referral_stats_total', table_name='referral_stats')
+    op.drop_table('referral_stats')
@@ -1,23 +1,58 @@
 import os
+from contextlib import asynccontextmanager
+from typing import Literal, Optional
 
-from fastapi import FastAPI
+from fastapi import Depends, FastAPI, HTTPException, Query
+from fastapi.responses import (
+    JSONResponse,
+    PlainTextResponse,
+    StreamingResponse,
+)
 
 from dotenv import load_dotenv
-from sqlalchemy import text
+from sqlalchemy import exc
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from stakewolle.backend import (
     auth_backend,
     fastapi_users,
     google_oauth_client,
 )
-from stakewolle.engine import engine
+from stakewolle.engine import (
+    engine,
+    get_async_session,
+    pool_stats,
+    read_engine,
+)
+from stakewolle.hashing import password_hash_pool
+from stakewolle.invalidation import invalidation_bus
+from stakewolle.metrics import (
+    RequestMetricsMiddleware,
+    render_metrics,
+    worker_metrics,
+)
+from stakewolle.models.models import User
+from stakewolle.queries import user_list
 from stakewolle.schemas.users import UserCreate, UserRead, UserUpdate
 from stakewolle.routers.referral import router as referral_router
+from stakewolle.routers.users import router as users_router
+from stakewolle.streaming import stream_csv, stream_ndjson
 
 
 load_dotenv()
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await invalidation_bus.start()
+    await worker_metrics.start()
+    yield
+    await worker_metrics.stop()
+    await invalidation_bus.stop()
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(RequestMetricsMiddleware)
 
 app.include_router(
     fastapi_users.get_auth_router(
@@ -61,10 +96,71 @@ app.include_router(
 )
 
 app.include_router(referral_router)
+app.include_router(users_router)
+
+
+@app.exception_handler(exc.TimeoutError)
+async def pool_timeout_handler(request, error):
+    # Every pooled connection is busy for longer than DB_POOL_TIMEOUT
+    return JSONResponse(
+        status_code=503,
+        content={'detail': 'Database is overloaded, try again later'},
+        headers={'Retry-After': '1'},
+    )
+
+
+@app.get('/health/')
+async def health():
+    stats = {
+        'database': pool_stats(engine),
+        'password_hash_pool': password_hash_pool.stats(),
+    }
+    if read_engine is not engine:
+        stats['replica'] = pool_stats(read_engine)
+    return stats
+
+
+@app.get('/metrics', include_in_schema=False)
+async def metrics():
+    return PlainTextResponse(
+        render_metrics(),
+        media_type='text/plain; version=0.0.4',
+    )
 
 
 @app.get('/')
-async def index():
-    async with engine.begin() as conn:
-        result = await conn.execute(text('SELECT * FROM "user";'))
-        return {'message': 'Userlist', 'List': result.scalars().fetchall()}
+async def index(
+    limit: int = Query(100, ge=1, le=1000),
+    after: Optional[int] = None,
+    export: Optional[Literal['ndjson', 'csv']] = None,
+    user: Optional[User] = Depends(
+        fastapi_users.current_user(active=True, optional=True),
+    ),
+    session: AsyncSession = Depends(get_async_session),
+):
+    # Full exports include emails and are streamed from
+    # a server-side cursor, superusers only
+    if export is not None:
+        if user is None or not user.is_superuser:
+            raise HTTPException(403, 'Export is available to superusers only')
+        query = user_list(after, with_email=True)
+        if export == 'csv':
+            return StreamingResponse(
+                stream_csv(query),
+                media_type='text/csv',
+                headers={
+                    'Content-Disposition': 'attachment; filename="users.csv"',
+                },
+            )
+        return StreamingResponse(
+            stream_ndjson(query),
+            media_type='application/x-ndjson',
+        )
+
+    result = await session.execute(user_list(after).limit(limit))
+    result = result.mappings().fetchall()
+    return {
+        'message': 'Userlist',
+        'List': result,
+        'after': result[-1]['id'] if len(result) == limit else None,
+    }
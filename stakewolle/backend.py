@@ -1,9 +1,12 @@
 import datetime
 import os
+import time
 import pytz
-from typing import Optional
+from dataclasses import dataclass
+from typing import Any, Optional
 
 from dotenv import load_dotenv
+import jwt
 from fastapi import Depends, Request, HTTPException
 from fastapi_users import (
     BaseUserManager,
@@ -18,16 +21,35 @@ from fastapi_users.authentication import (
     CookieTransport,
     JWTStrategy,
 )
+from fastapi.security import OAuth2PasswordRequestForm
 from fastapi_users.db import SQLAlchemyUserDatabase
+from fastapi_users.jwt import decode_jwt, generate_jwt
 from httpx_oauth.clients.google import GoogleOAuth2
-from sqlalchemy import select
-
-from stakewolle.engine import async_session_maker, get_user_db
+from sqlalchemy import insert, literal, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.attributes import set_committed_value
+
+from stakewolle.cache import MISSING, referral_cache, revoked_users, user_cache
+from stakewolle.engine import get_user_db
+from stakewolle.hashing import password_hash_pool
+from stakewolle.invalidation import invalidation_bus
 from stakewolle.models.models import User, Referral
+from stakewolle.queries import (
+    insert_ignoring_conflicts,
+    referrals_by_codes,
+    users_by_emails,
+)
+from stakewolle.referral_stats import count_referrals
 
 
 load_dotenv()
 SECRET = os.getenv('SECRET_KEY', '')
+JWT_LIFETIME = int(os.getenv('JWT_LIFETIME', 3600))
+# Trust the claims of the token on read-only endpoints instead of
+# loading the user on every request
+JWT_STATELESS = os.getenv('JWT_STATELESS', 'false').lower() == 'true'
+# Rows per INSERT and per lookup query of UserManager.bulk_create
+BULK_IMPORT_BATCH_SIZE = int(os.getenv('BULK_IMPORT_BATCH_SIZE', 1000))
 
 google_oauth_client = GoogleOAuth2(
     os.getenv("GOOGLE_OAUTH_CLIENT_ID", ""),
@@ -35,6 +57,28 @@ google_oauth_client = GoogleOAuth2(
 )
 
 
+@dataclass(frozen=True)
+class TokenUser:
+    """
+    What read-only endpoints know about the authenticated user: the claims
+    of a stateless token or a short-lived snapshot of the user row.
+    """
+
+    id: int
+    is_active: bool
+    is_verified: bool
+    is_superuser: bool
+
+    @classmethod
+    def from_user(cls, user: User) -> 'TokenUser':
+        return cls(
+            id=user.id,
+            is_active=user.is_active,
+            is_verified=user.is_verified,
+            is_superuser=user.is_superuser,
+        )
+
+
 class UserManager(IntegerIDMixin, BaseUserManager[User, int]):
     reset_password_token_secret = SECRET
     verification_token_secret = SECRET
@@ -54,24 +98,176 @@ class UserManager(IntegerIDMixin, BaseUserManager[User, int]):
     ):
         print(f"Verification requested for user {user.id}. Verification token: {token}")  # noqa: E501
 
-    async def get_referral_expiring_date(self, user_dict: dict):
-        async with async_session_maker.begin() as session:
-            result = await session.execute(
-                select(Referral.expires_at).
-                where(Referral.referral == user_dict['referral_name']),
+    async def hash_password(self, password: str) -> str:
+        return await password_hash_pool.run(
+            self.password_helper.hash,
+            password,
+        )
+
+    async def _release_connection(self):
+        """
+        End the transaction of the session, so that its pooled connection
+        is not held while waiting for the password hash pool. Loaded users
+        stay usable, the session does not expire them on commit.
+        """
+        await self.user_db.session.commit()
+
+    async def authenticate(
+        self, credentials: OAuth2PasswordRequestForm
+    ) -> Optional[models.UP]:
+        """
+        Authenticate and return a user following an email and a password.
+
+        Same as BaseUserManager.authenticate, with hashing done
+        in the password hash pool.
+        """
+        try:
+            user = await self.get_by_email(credentials.username)
+        except exceptions.UserNotExists:
+            user = None
+        await self._release_connection()
+        if user is None:
+            # Run the hasher to mitigate timing attack
+            await self.hash_password(credentials.password)
+            return None
+
+        verified, updated_password_hash = await password_hash_pool.run(
+            self.password_helper.verify_and_update,
+            credentials.password,
+            user.hashed_password,
+        )
+        if not verified:
+            return None
+        # Update password hash to a more robust one if needed
+        if updated_password_hash is not None:
+            await self.user_db.update(
+                user,
+                {"hashed_password": updated_password_hash},
             )
-            return result.scalars().fetchall()[0]
 
-    async def is_referral_exists(self, user_dict: dict):
-        async with async_session_maker.begin() as session:
+        return user
+
+    async def _update(self, user: User, update_dict: dict[str, Any]) -> User:
+        # Hash new passwords in the pool, the rest is left to the base class
+        password = update_dict.get('password')
+        if password is not None:
+            await self.validate_password(password, user)
+            await self._release_connection()
+            update_dict = {
+                field: value for field, value in update_dict.items()
+                if field != 'password'
+            }
+            update_dict['hashed_password'] = await self.hash_password(password)
+        return await super()._update(user, update_dict)
+
+    async def on_after_delete(
+        self, user: User, request: Optional[Request] = None
+    ):
+        await invalidation_bus.publish(
+            'user',
+            user_id=user.id,
+            email=user.email,
+            revoked_at=time.time(),
+        )
+
+    async def update(
+        self,
+        user_update: schemas.UU,
+        user: models.UP,
+        safe: bool = False,
+        request: Optional[Request] = None,
+    ) -> models.UP:
+        # The row is updated in place, remember what it was cached by
+        previous_email = user.email
+        previous_claims = TokenUser.from_user(user)
+        updated_user = await super().update(user_update, user, safe, request)
+
+        # Tokens carrying the old claims must not be trusted anymore
+        revoked_at = None
+        if TokenUser.from_user(updated_user) != previous_claims:
+            revoked_at = time.time()
+        await invalidation_bus.publish(
+            'user',
+            user_id=updated_user.id,
+            email=previous_email,
+            revoked_at=revoked_at,
+        )
+        if updated_user.email != previous_email:
+            # Lookups of the new address may have cached "no referral"
+            await invalidation_bus.publish(
+                'referral',
+                email=updated_user.email,
+            )
+        return updated_user
+
+    async def create_referred_user(self, user_dict: dict) -> User:
+        """
+        Insert a user registered with a referral code.
+
+        Existence and expiry of the referral are checked by the INSERT
+        itself (INSERT ... SELECT FROM referral), so the check and the
+        write happen in one statement on the request session and a code
+        deleted or expired in between cannot slip through. The referral
+        stats of the referrer are updated on the same transaction.
+
+        :param user_dict: Column values of the new user.
+        :raises HTTPException: 422 if the referral does not exist or was
+        deleted meanwhile, 400 if it has expired.
+        :return: The created user.
+        """
+        session = self.user_db.session
+        referral_name = user_dict['referral_name']
+        columns = list(user_dict)
+        valid_referral = (
+            select(*[
+                literal(user_dict[column], User.__table__.c[column].type)
+                for column in columns
+            ]).
+            where(
+                Referral.referral == referral_name,
+                Referral.expires_at >= datetime.datetime.now(pytz.utc),
+            )
+        )
+        # Read by the same statement, for the referral stats
+        referrer_id = (
+            select(Referral.user_id).
+            where(Referral.referral == referral_name).
+            scalar_subquery()
+        )
+        error = None
+        try:
             result = await session.execute(
-                select(Referral).
-                where(Referral.referral == user_dict['referral_name']),
+                insert(User).
+                from_select(columns, valid_referral).
+                returning(User, referrer_id),
             )
-            result = result.scalar_one_or_none()
-            if result:
-                return True
-            return False
+            created = result.unique().one_or_none()
+        except IntegrityError as exc:
+            # A referral deleted after the INSERT read it fails the
+            # foreign key, other conflicts are raised as they are
+            await session.rollback()
+            error, created = exc, None
+
+        if created is None:
+            # Nothing was inserted, find out why
+            referral_expires_at = await session.scalar(
+                select(Referral.expires_at).
+                where(Referral.referral == referral_name),
+            )
+            await session.rollback()
+            if referral_expires_at is None:
+                referral_cache.set(None, code=referral_name)
+                raise HTTPException(422, 'Referral does not exists')
+            if error is not None:
+                raise error
+            raise HTTPException(400, 'Referral was expired')
+
+        user, referrer_id = created
+        # Loaded from RETURNING, a new user has no OAuth accounts
+        set_committed_value(user, 'oauth_accounts', [])
+        await count_referrals(session, [(referrer_id, user.registered_at)])
+        await session.commit()
+        return user
 
     async def create(
         self,
@@ -94,9 +290,17 @@ class UserManager(IntegerIDMixin, BaseUserManager[User, int]):
         """
         await self.validate_password(user_create.password, user_create)
 
+        # Codes known to be missing are rejected without touching
+        # the database, a valid code is still checked by the INSERT itself
+        if user_create.referral_name and (
+            referral_cache.get_by_code(user_create.referral_name) is None
+        ):
+            raise HTTPException(422, 'Referral does not exists')
+
         existing_user = await self.user_db.get_by_email(user_create.email)
         if existing_user is not None:
             raise exceptions.UserAlreadyExists()
+        await self._release_connection()
 
         user_dict = (
             user_create.create_update_dict()
@@ -104,28 +308,229 @@ class UserManager(IntegerIDMixin, BaseUserManager[User, int]):
             else user_create.create_update_dict_superuser()
         )
         password = user_dict.pop("password")
-        user_dict["hashed_password"] = self.password_helper.hash(password)
+        user_dict["hashed_password"] = await self.hash_password(password)
 
-        try:
-            if user_dict['referral_name'] != '':
-                referral_exists = await self.is_referral_exists(user_dict)
-                if not referral_exists:
-                    raise HTTPException(422, 'Referral does not exists')
-
-                referral_expires_at = await self.get_referral_expiring_date(user_dict)  # noqa: E501
-                if datetime.datetime.now(pytz.utc) > referral_expires_at:
-                    raise HTTPException(400, 'Referral was expired')
-            else:
-                user_dict['referral_name'] = None
-        except KeyError:
+        if user_dict.get('referral_name'):
+            created_user = await self.create_referred_user(user_dict)
+        else:
             user_dict['referral_name'] = None
-
-        created_user = await self.user_db.create(user_dict)
+            created_user = await self.user_db.create(user_dict)
 
         await self.on_after_register(created_user, request)
 
         return created_user
 
+    async def bulk_create(self, user_creates: list[schemas.UC]) -> list[dict]:
+        """
+        Create many users at once, for partner imports.
+
+        Referral codes and emails are checked with one query per batch,
+        passwords are then hashed in parallel in the password hash pool,
+        outside of any transaction, and users are inserted with multi-row
+        INSERT ... ON CONFLICT DO NOTHING, in one transaction together with
+        the referral stats.
+        Sensitive values are ignored like with safe=True,
+        on_after_register is not triggered.
+
+        :param user_creates: The UserCreate models to create.
+        :raises HTTPException: 409 if a referral was deleted meanwhile.
+        :return: Result of every row in input order, with its index, email,
+        status ('created', 'exists', 'duplicate', 'invalid_password',
+        'invalid_referral' or 'expired_referral'), user id and detail.
+        """
+        results = [
+            {
+                'index': index,
+                'email': user_create.email,
+                'status': None,
+                'id': None,
+                'detail': None,
+            }
+            for index, user_create in enumerate(user_creates)
+        ]
+        pending = await self._validate_bulk_rows(user_creates, results)
+        referrers = await self._check_bulk_referrals(
+            user_creates,
+            results,
+            pending,
+        )
+        pending = list(referrers)
+        # Rows taken while hashing are skipped by ON CONFLICT DO NOTHING,
+        # deleted referrals fail the insert
+        await self._release_connection()
+
+        hashed_passwords = await password_hash_pool.map(
+            self.password_helper.hash,
+            [user_creates[index].password for index in pending],
+        )
+        rows = [
+            {
+                'email': user_creates[index].email,
+                'username': user_creates[index].username,
+                'hashed_password': hashed_password,
+                'referral_name': user_creates[index].referral_name or None,
+                'is_active': True,
+                'is_verified': False,
+                'is_superuser': False,
+            }
+            for index, hashed_password in zip(pending, hashed_passwords)
+        ]
+        created = await self._insert_bulk_rows(rows)
+
+        signups = []
+        for index in pending:
+            if user_creates[index].email not in created:
+                self._bulk_fail(
+                    results[index],
+                    'exists',
+                    'Email or username is already taken',
+                )
+                continue
+            user_id, registered_at = created[user_creates[index].email]
+            results[index].update(status='created', id=user_id)
+            if referrers[index] is not None:
+                signups.append((referrers[index], registered_at))
+        await count_referrals(self.user_db.session, signups)
+        await self.user_db.session.commit()
+        return results
+
+    async def _validate_bulk_rows(
+        self,
+        user_creates: list[schemas.UC],
+        results: list[dict],
+    ) -> list[int]:
+        """
+        :return: Indexes of the rows with valid passwords, which do not
+        repeat an earlier row and whose email is not registered yet.
+        """
+        pending = []
+        emails = set()
+        usernames = set()
+        for index, user_create in enumerate(user_creates):
+            try:
+                await self.validate_password(user_create.password, user_create)
+            except exceptions.InvalidPasswordException as error:
+                self._bulk_fail(
+                    results[index],
+                    'invalid_password',
+                    error.reason,
+                )
+                continue
+            email = user_create.email.lower()
+            if email in emails or user_create.username in usernames:
+                self._bulk_fail(
+                    results[index],
+                    'duplicate',
+                    'Repeats the email or username of an earlier row',
+                )
+                continue
+            emails.add(email)
+            usernames.add(user_create.username)
+            pending.append(index)
+
+        existing = set()
+        emails = list(emails)
+        for start in range(0, len(emails), BULK_IMPORT_BATCH_SIZE):
+            existing.update(await self.user_db.session.scalars(
+                users_by_emails(emails[start:start + BULK_IMPORT_BATCH_SIZE]),
+            ))
+        for index in pending:
+            if user_creates[index].email.lower() in existing:
+                self._bulk_fail(
+                    results[index],
+                    'exists',
+                    'Email is already registered',
+                )
+        return [index for index in pending if results[index]['status'] is None]
+
+    async def _check_bulk_referrals(
+        self,
+        user_creates: list[schemas.UC],
+        results: list[dict],
+        pending: list[int],
+    ) -> dict[int, Optional[int]]:
+        """
+        :return: Index -> referrer id (None without a referral code)
+        of the pending rows without a referral code or with a valid one.
+        """
+        codes = list({
+            user_creates[index].referral_name for index in pending
+            if user_creates[index].referral_name
+        })
+        expires_at = {}
+        referrer_ids = {}
+        for start in range(0, len(codes), BULK_IMPORT_BATCH_SIZE):
+            batch = codes[start:start + BULK_IMPORT_BATCH_SIZE]
+            result = await self.user_db.session.execute(
+                referrals_by_codes(batch),
+            )
+            for code, code_expires_at, referrer_id in result.tuples():
+                # SQLite returns naive datetimes, they are stored in UTC
+                if code_expires_at.tzinfo is None:
+                    code_expires_at = code_expires_at.replace(tzinfo=pytz.utc)
+                expires_at[code] = code_expires_at
+                referrer_ids[code] = referrer_id
+
+        now = datetime.datetime.now(pytz.utc)
+        valid = {}
+        for index in pending:
+            code = user_creates[index].referral_name
+            if not code:
+                valid[index] = None
+            elif code not in expires_at:
+                self._bulk_fail(
+                    results[index],
+                    'invalid_referral',
+                    'Referral does not exists',
+                )
+            elif expires_at[code] < now:
+                self._bulk_fail(
+                    results[index],
+                    'expired_referral',
+                    'Referral was expired',
+                )
+            else:
+                valid[index] = referrer_ids[code]
+        return valid
+
+    async def _insert_bulk_rows(
+        self,
+        rows: list[dict],
+    ) -> dict[str, tuple[int, datetime.datetime]]:
+        """
+        Insert rows on the session's transaction, the caller commits.
+
+        :return: Email -> id and registration time of the inserted users.
+        Rows conflicting with an existing email or username are skipped.
+        """
+        session = self.user_db.session
+        statement = insert_ignoring_conflicts(
+            User.__table__,
+            session.get_bind().dialect.name,
+        ).returning(User.id, User.email, User.registered_at)
+        created = {}
+        try:
+            for start in range(0, len(rows), BULK_IMPORT_BATCH_SIZE):
+                result = await session.execute(
+                    statement.values(rows[start:start + BULK_IMPORT_BATCH_SIZE]),  # noqa: E501
+                )
+                created.update(
+                    (email, (user_id, registered_at))
+                    for user_id, email, registered_at in result.tuples()
+                )
+        except IntegrityError:
+            # Only the referral foreign key can fail, conflicts are skipped
+            await session.rollback()
+            raise HTTPException(
+                409,
+                'Referrals were changed during the import, try again',
+            )
+        return created
+
+    @staticmethod
+    def _bulk_fail(result: dict, status: str, detail: Any):
+        result.update(status=status, detail=detail)
+
 
 async def get_user_manager(
     user_db: SQLAlchemyUserDatabase = Depends(get_user_db)
@@ -135,12 +540,37 @@ async def get_user_manager(
 
 cookie_transport = CookieTransport(
     cookie_name='cookie_transport',
-    cookie_max_age=3600,
+    cookie_max_age=JWT_LIFETIME,
 )
 
 
+class ClaimsJWTStrategy(JWTStrategy):
+    """
+    JWT strategy that also writes the issue time and the active, verified
+    and superuser flags into the token, so that current_token_user can
+    authenticate without a database round trip.
+    """
+
+    async def write_token(self, user: User) -> str:
+        data = {
+            'sub': str(user.id),
+            'aud': self.token_audience,
+            # Fractional, like the revocation timestamps it is compared to
+            'iat': time.time(),
+            'is_active': user.is_active,
+            'is_verified': user.is_verified,
+            'is_superuser': user.is_superuser,
+        }
+        return generate_jwt(
+            data,
+            self.encode_key,
+            self.lifetime_seconds,
+            algorithm=self.algorithm,
+        )
+
+
 def get_jwt_strategy() -> JWTStrategy:
-    return JWTStrategy(secret=SECRET, lifetime_seconds=3600)
+    return ClaimsJWTStrategy(secret=SECRET, lifetime_seconds=JWT_LIFETIME)
 
 
 auth_backend = AuthenticationBackend(
@@ -152,3 +582,55 @@ auth_backend = AuthenticationBackend(
 fastapi_users = FastAPIUsers[User, int](get_user_manager, [auth_backend])  # noqa: E501
 
 current_active_user = fastapi_users.current_user(active=True)
+current_superuser = fastapi_users.current_user(active=True, superuser=True)
+
+
+async def current_token_user(
+    token: Optional[str] = Depends(cookie_transport.scheme),
+    user_manager: UserManager = Depends(get_user_manager),
+) -> TokenUser:
+    """
+    Authenticate read-only endpoints without loading the user row.
+
+    With JWT_STATELESS the claims of the token are trusted, otherwise the
+    user is read through the short-lived user cache. Either way tokens
+    issued before the user was deactivated or had their flags changed are
+    rejected through the revocation list.
+    Unlike current_active_user this returns a TokenUser snapshot, never
+    use it on endpoints that modify the user.
+    """
+    strategy = get_jwt_strategy()
+    try:
+        data = decode_jwt(
+            token,
+            strategy.decode_key,
+            strategy.token_audience,
+            algorithms=[strategy.algorithm],
+        )
+        user_id = user_manager.parse_id(data['sub'])
+    except (jwt.PyJWTError, KeyError, TypeError, exceptions.InvalidID):
+        raise HTTPException(401, 'Unauthorized')
+
+    revoked_at = revoked_users.get(user_id)
+    if revoked_at is not MISSING and data.get('iat', 0) <= revoked_at:
+        raise HTTPException(401, 'Unauthorized')
+
+    if JWT_STATELESS and 'is_active' in data:
+        user = TokenUser(
+            id=user_id,
+            is_active=data['is_active'],
+            is_verified=data['is_verified'],
+            is_superuser=data['is_superuser'],
+        )
+    else:
+        user = user_cache.get(user_id)
+        if user is MISSING:
+            try:
+                user = TokenUser.from_user(await user_manager.get(user_id))
+            except exceptions.UserNotExists:
+                user = None
+            user_cache.set(user_id, user)
+
+    if user is None or not user.is_active:
+        raise HTTPException(401, 'Unauthorized')
+    return user
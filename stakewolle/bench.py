@@ -0,0 +1,372 @@
+"""
+Load and latency benchmark of the API.
+
+Boots stakewolle.app:app in-process against a throwaway database, seeds it
+with users and referrals and replays a fixed mix of requests from several
+concurrent clients. Reports p50/p95/p99 latency, throughput and the number
+of SQL statements and pool checkouts per request. The request mix is
+generated from --seed, so results of different commits are comparable.
+
+The database is dropped and recreated. It is a temporary SQLite file
+unless --database-url is given, never the DATABASE_URL of the environment.
+
+Usage: python -m stakewolle.bench [--users 1000] [--requests 2000]
+    [--output result.json] [--baseline previous.json]
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+
+PASSWORD = 'bench-password'
+EMAIL = 'user{}@bench.example.com'
+DEFAULT_MIX = {
+    'register': 5,
+    'login': 5,
+    'get_by_email': 30,
+    'get_my_referral': 25,
+    'new_delete': 10,
+    'referrals': 25,
+}
+# Statement and checkout counters of the request being measured
+_request_stats: ContextVar[Optional[dict]] = ContextVar(
+    '_request_stats',
+    default=None,
+)
+
+
+def _count(key: str):
+    def listener(*args, **kwargs):
+        stats = _request_stats.get()
+        if stats is not None:
+            stats[key] += 1
+    return listener
+
+
+async def seed(users: int, referrals: int):
+    from fastapi_users.password import PasswordHelper
+    from sqlalchemy import insert
+
+    from stakewolle.engine import engine
+    from stakewolle.models.models import Base, Referral, User
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+
+    hashed_password = PasswordHelper().hash(PASSWORD)
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    def user(i: int, referral_name: Optional[str] = None) -> dict:
+        return {
+            'email': EMAIL.format(i),
+            'username': f'user{i}',
+            'hashed_password': hashed_password,
+            'referral_name': referral_name,
+            'registered_at': now,
+            'is_active': True,
+            'is_verified': False,
+            'is_superuser': False,
+        }
+
+    async def insert_rows(conn, table, rows: list):
+        for start in range(0, len(rows), 1000):
+            await conn.execute(insert(table), rows[start:start + 1000])
+
+    # Users 1..referrals are referrers, the rest are referred by them.
+    # The tables are new, so users get ids in the order of insertion
+    async with engine.begin() as conn:
+        await insert_rows(conn, User, [
+            user(i) for i in range(1, referrals + 1)
+        ])
+        await insert_rows(conn, Referral, [
+            {
+                'referral': f'BENCH{i}',
+                'user_id': i,
+                'created_at': now,
+                'expires_at': now + datetime.timedelta(days=30),
+            }
+            for i in range(1, referrals + 1)
+        ])
+        await insert_rows(conn, User, [
+            user(i, f'BENCH{i % referrals + 1}')
+            for i in range(referrals + 1, users + 1)
+        ])
+
+
+class Client:
+    """
+    One simulated user, logged in as a seeded user without a referral.
+    """
+
+    def __init__(self, http, user_id: int, referrers: int, rng):
+        self.http = http
+        self.user_id = user_id
+        self.referrers = referrers
+        self.rng = rng
+        self.has_referral = False
+        self.sequence = 0
+
+    async def login(self):
+        return await self.http.post('/auth/jwt/login', data={
+            'username': EMAIL.format(self.user_id),
+            'password': PASSWORD,
+        })
+
+    async def register(self):
+        self.sequence += 1
+        body = {
+            'email': f'new{self.user_id}-{self.sequence}@bench.example.com',
+            'username': f'new{self.user_id}-{self.sequence}',
+            'password': PASSWORD,
+        }
+        if self.rng.random() < 0.5:
+            body['referral_name'] = f'BENCH{self._referrer()}'
+        return await self.http.post('/auth/register', json=body)
+
+    async def get_by_email(self):
+        return await self.http.get(
+            '/referral/get_by_email/',
+            params={'email': EMAIL.format(self._referrer())},
+        )
+
+    async def get_my_referral(self):
+        return await self.http.get('/referral/get_my_referral/')
+
+    async def new_delete(self):
+        if self.has_referral:
+            response = await self.http.delete('/referral/delete/')
+        else:
+            self.sequence += 1
+            expires_at = datetime.datetime.now(datetime.timezone.utc)
+            response = await self.http.post('/referral/new/', json={
+                'referral': f'W{self.user_id}-{self.sequence}',
+                'expires_at': (expires_at + datetime.timedelta(days=1)).isoformat(),  # noqa: E501
+            })
+        if response.is_success:
+            self.has_referral = not self.has_referral
+        return response
+
+    async def referrals(self):
+        return await self.http.get(
+            f'/referral/get_referrals_by_referrer_id/{self._referrer()}/',
+        )
+
+    def _referrer(self) -> int:
+        return self.rng.randint(1, self.referrers)
+
+
+def percentile(values: list, q: int) -> float:
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100, method='inclusive')[q - 1]
+
+
+async def run(args) -> dict:
+    import httpx
+    from sqlalchemy import event
+
+    from stakewolle.app import app
+    from stakewolle.engine import engine, read_engine
+
+    await seed(args.users, args.referrals)
+    for target in {engine, read_engine}:
+        event.listen(
+            target.sync_engine,
+            'before_cursor_execute',
+            _count('queries'),
+        )
+        event.listen(target.sync_engine, 'checkout', _count('connections'))
+
+    rng = random.Random(args.seed)
+    ops = rng.choices(
+        list(args.mix),
+        weights=list(args.mix.values()),
+        k=args.requests,
+    )
+    samples = {op: [] for op in args.mix}
+    errors = {op: 0 for op in args.mix}
+
+    async def worker(client: Client, plan: list):
+        for op in plan:
+            stats = {'queries': 0, 'connections': 0}
+            token = _request_stats.set(stats)
+            start = time.perf_counter()
+            try:
+                response = await getattr(client, op)()
+                ok = response.is_success
+            except Exception:
+                ok = False
+            finally:
+                _request_stats.reset(token)
+            samples[op].append((time.perf_counter() - start, stats))
+            if not ok:
+                errors[op] += 1
+
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app):
+        http_clients = [
+            httpx.AsyncClient(transport=transport, base_url='https://bench')
+            for _ in range(args.concurrency)
+        ]
+        clients = [
+            Client(
+                http,
+                args.referrals + 1 + i,
+                args.referrals,
+                random.Random(args.seed + i),
+            )
+            for i, http in enumerate(http_clients)
+        ]
+        for client in clients:
+            (await client.login()).raise_for_status()
+
+        start = time.perf_counter()
+        await asyncio.gather(*[
+            worker(client, ops[i::args.concurrency])
+            for i, client in enumerate(clients)
+        ])
+        wall = time.perf_counter() - start
+
+        for http in http_clients:
+            await http.aclose()
+    await engine.dispose()
+    if read_engine is not engine:
+        await read_engine.dispose()
+
+    return summarize(args, wall, samples, errors)
+
+
+def summarize(args, wall: float, samples: dict, errors: dict) -> dict:
+    result = {
+        'requests': args.requests,
+        'concurrency': args.concurrency,
+        'seconds': wall,
+        'throughput': args.requests / wall,
+        'endpoints': {},
+    }
+    for op, op_samples in samples.items():
+        if not op_samples:
+            continue
+        latencies = [seconds * 1000 for seconds, _ in op_samples]
+        result['endpoints'][op] = {
+            'requests': len(op_samples),
+            'errors': errors[op],
+            'p50_ms': percentile(latencies, 50),
+            'p95_ms': percentile(latencies, 95),
+            'p99_ms': percentile(latencies, 99),
+            'queries': statistics.mean(s['queries'] for _, s in op_samples),
+            'connections': statistics.mean(
+                s['connections'] for _, s in op_samples
+            ),
+        }
+    return result
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> list:
+    """
+    :return: Descriptions of the metrics that got worse than tolerance
+    """
+    regressions = []
+    if result['throughput'] < baseline['throughput'] * (1 - tolerance):
+        regressions.append(
+            f"throughput: {baseline['throughput']:.1f} -> {result['throughput']:.1f}",  # noqa: E501
+        )
+    for op, stats in result['endpoints'].items():
+        previous = baseline['endpoints'].get(op)
+        if previous is None:
+            continue
+        for metric in ('p95_ms', 'queries'):
+            if stats[metric] > previous[metric] * (1 + tolerance):
+                regressions.append(
+                    f'{op} {metric}: {previous[metric]:.2f} -> {stats[metric]:.2f}',  # noqa: E501
+                )
+    return regressions
+
+
+def print_result(result: dict):
+    print(
+        f"{result['requests']} requests, {result['concurrency']} clients, "
+        f"{result['seconds']:.2f} s, {result['throughput']:.1f} req/s",
+    )
+    print(f"{'endpoint':<16}{'n':>6}{'err':>5}{'p50':>9}{'p95':>9}"
+          f"{'p99':>9}{'queries':>9}{'conns':>7}")
+    for op, stats in result['endpoints'].items():
+        print(
+            f"{op:<16}{stats['requests']:>6}{stats['errors']:>5}"
+            f"{stats['p50_ms']:>9.2f}{stats['p95_ms']:>9.2f}"
+            f"{stats['p99_ms']:>9.2f}{stats['queries']:>9.2f}"
+            f"{stats['connections']:>7.2f}",
+        )
+
+
+def parse_mix(value: str) -> dict:
+    mix = {}
+    for item in value.split(','):
+        op, _, weight = item.partition('=')
+        if op not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f'Unknown endpoint: {op}')
+        mix[op] = float(weight)
+    return mix
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--database-url',
+                        help='throwaway database, temporary SQLite if unset')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--referrals', type=int, default=200,
+                        help='how many of the users are referrers')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help='weights like get_by_email=30,login=5')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the result as JSON')
+    parser.add_argument('--baseline', help='JSON result to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args(argv)
+    if args.users < args.referrals + args.concurrency:
+        parser.error('--users must cover --referrals and --concurrency')
+    return args
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    with tempfile.TemporaryDirectory() as directory:
+        # Set before stakewolle reads its settings, .env does not
+        # override variables that are already set
+        os.environ['DATABASE_URL'] = args.database_url or (
+            f"sqlite+aiosqlite:///{os.path.join(directory, 'bench.db')}"
+        )
+        os.environ['DATABASE_REPLICA_URL'] = ''
+        os.environ['INVALIDATION_BACKEND'] = 'local'
+        os.environ.setdefault('SECRET_KEY', 'bench-secret-key-' + 'x' * 32)
+        result = asyncio.run(run(args))
+
+    print_result(result)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(result, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(result, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
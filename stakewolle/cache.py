@@ -0,0 +1,241 @@
+import datetime
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Hashable, Optional
+
+import pytz
+from dotenv import load_dotenv
+
+from stakewolle.invalidation import invalidation_bus
+
+
+load_dotenv()
+REFERRAL_CACHE_SIZE = int(os.getenv('REFERRAL_CACHE_SIZE', 10000))
+REFERRAL_CACHE_TTL = float(os.getenv('REFERRAL_CACHE_TTL', 60))
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 10000))
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', 30))
+# Revocations are kept as long as a token issued before them can live
+REVOCATION_TTL = float(os.getenv('JWT_LIFETIME', 3600))
+
+MISSING = object()
+
+
+class TTLCache:
+    """
+    Bounded in-process LRU cache whose entries expire after ``ttl`` seconds.
+
+    An entry may also carry an absolute ``expires_at`` datetime, after which
+    it is treated as missing regardless of its TTL.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Any:
+        """
+        :param key: Cache key.
+        :return: The cached value or MISSING.
+        """
+        entry = self._entries.get(key, MISSING)
+        if entry is not MISSING:
+            value, deadline, expires_at = entry
+            if time.monotonic() < deadline and (
+                expires_at is None
+                or datetime.datetime.now(pytz.utc) < expires_at
+            ):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._entries[key]
+        self.misses += 1
+        return MISSING
+
+    def set(
+        self,
+        key: Hashable,
+        value: Any,
+        expires_at: Optional[datetime.datetime] = None,
+    ):
+        if expires_at is not None and expires_at.tzinfo is None:
+            expires_at = expires_at.replace(tzinfo=pytz.utc)
+        self._entries[key] = (value, time.monotonic() + self.ttl, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: Hashable):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class RevocationList:
+    """
+    In-process revocation timestamps keyed by user id, kept for ``ttl``
+    seconds.
+
+    Unlike TTLCache it is not bounded: evicting a revocation early would
+    make the tokens it rejects valid again, so entries only expire.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.revocations = 0
+        self.expirations = 0
+        # Same TTL for every entry, so insertion order is expiry order
+        self._entries: OrderedDict = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Any:
+        """
+        :param key: User id.
+        :return: The latest revocation timestamp or MISSING.
+        """
+        self._expire()
+        entry = self._entries.get(key, MISSING)
+        return entry if entry is MISSING else entry[0]
+
+    def set(self, key: Hashable, revoked_at: float):
+        self._expire()
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            # Messages may arrive out of order, keep the latest revocation
+            revoked_at = max(revoked_at, previous[0])
+        self._entries[key] = (revoked_at, time.monotonic() + self.ttl)
+        self.revocations += 1
+
+    def stats(self) -> dict:
+        self._expire()
+        return {
+            'size': len(self._entries),
+            'revocations': self.revocations,
+            'expirations': self.expirations,
+        }
+
+    def _expire(self):
+        now = time.monotonic()
+        while self._entries:
+            key, (_, deadline) = next(iter(self._entries.items()))
+            if now < deadline:
+                break
+            del self._entries[key]
+            self.expirations += 1
+
+
+@dataclass(frozen=True)
+class CachedReferral:
+    referral: str
+    user_id: int
+    expires_at: datetime.datetime
+
+
+class ReferralCache:
+    """
+    Referral lookups keyed by code, referrer email and referrer user_id.
+
+    ``None`` is cached as "no referral". A cached referral is dropped as soon
+    as its ``expires_at`` passes, so the cache can never vouch for an
+    expired code.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.entries = TTLCache(maxsize, ttl)
+
+    def get_by_code(self, code: str):
+        return self.entries.get(('code', code))
+
+    def get_by_email(self, email: str):
+        return self.entries.get(('email', email))
+
+    def get_by_user_id(self, user_id: int):
+        return self.entries.get(('user_id', user_id))
+
+    def set(
+        self,
+        referral: Optional[CachedReferral],
+        code: Optional[str] = None,
+        email: Optional[str] = None,
+        user_id: Optional[int] = None,
+    ):
+        expires_at = referral.expires_at if referral else None
+        if referral is not None:
+            code = referral.referral
+            user_id = referral.user_id
+        for key in self._keys(code, email, user_id):
+            self.entries.set(key, referral, expires_at)
+
+    def invalidate(
+        self,
+        code: Optional[str] = None,
+        email: Optional[str] = None,
+        user_id: Optional[int] = None,
+    ):
+        for key in self._keys(code, email, user_id):
+            self.entries.pop(key)
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self) -> dict:
+        return self.entries.stats()
+
+    def _keys(self, code, email, user_id) -> list:
+        keys = []
+        if code is not None:
+            keys.append(('code', code))
+        if email is not None:
+            keys.append(('email', email))
+        if user_id is not None:
+            keys.append(('user_id', user_id))
+        return keys
+
+
+referral_cache = ReferralCache(REFERRAL_CACHE_SIZE, REFERRAL_CACHE_TTL)
+# user_id -> authentication snapshot of the user
+user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+# user_id -> timestamp, tokens issued before it are rejected
+revoked_users = RevocationList(REVOCATION_TTL)
+
+
+def _invalidate_referral(message: dict):
+    referral_cache.invalidate(
+        code=message.get('code'),
+        email=message.get('email'),
+        user_id=message.get('user_id'),
+    )
+
+
+def _invalidate_user(message: dict):
+    user_cache.pop(message.get('user_id'))
+    if message.get('revoked_at') is not None:
+        revoked_users.set(message['user_id'], message['revoked_at'])
+
+
+invalidation_bus.subscribe('referral', _invalidate_referral)
+invalidation_bus.subscribe('user', _invalidate_referral)
+invalidation_bus.subscribe('user', _invalidate_user)
+invalidation_bus.subscribe('reset', lambda _: referral_cache.clear())
+invalidation_bus.subscribe('reset', lambda _: user_cache.clear())
@@ -1,27 +1,240 @@
+import logging
 import os
-from typing import AsyncGenerator
+import re
+import time
+from contextvars import ContextVar
+from typing import AsyncGenerator, Optional
 
 from dotenv import load_dotenv
 from fastapi import Depends
 from fastapi_users.db import SQLAlchemyUserDatabase
+from sqlalchemy import event, exc
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.asyncio import (
+    AsyncEngine,
     AsyncSession,
     async_sessionmaker,
     create_async_engine,
 )
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 from stakewolle.models.models import OAuthAccount, User
 
 
 load_dotenv()
-engine = create_async_engine(os.getenv('DATABASE_URL'))
+DATABASE_URL = os.getenv('DATABASE_URL')
+DATABASE_REPLICA_URL = os.getenv('DATABASE_REPLICA_URL')
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 10))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'true').lower() == 'true'
+DB_STATEMENT_CACHE_SIZE = int(os.getenv('DB_STATEMENT_CACHE_SIZE', 100))
+# Milliseconds, 0 disables the timeout
+DB_STATEMENT_TIMEOUT = int(os.getenv('DB_STATEMENT_TIMEOUT', 0))
+# Milliseconds, statements running longer are logged, 0 disables the log
+DB_SLOW_QUERY_MS = float(os.getenv('DB_SLOW_QUERY_MS', 200))
+
+slow_query_logger = logging.getLogger('stakewolle.slow_query')
+
+
+class RequestStats:
+    """
+    Database work done on behalf of one request, see request_stats.
+    """
+
+    __slots__ = (
+        'statements',
+        'db_time',
+        'pool_wait',
+        'slowest_time',
+        'slowest_statement',
+    )
+
+    def __init__(self):
+        self.statements = 0
+        self.db_time = 0.0
+        self.pool_wait = 0.0
+        self.slowest_time = 0.0
+        self.slowest_statement = None
+
+
+# Set by the metrics middleware for the duration of a request
+request_stats: ContextVar[Optional[RequestStats]] = ContextVar(
+    'request_stats',
+    default=None,
+)
+
+
+class QueryMetrics:
+    def __init__(self):
+        self.statements = 0
+        self.seconds = 0.0
+        self.slow = 0
+
+
+query_metrics = QueryMetrics()
+
+_LITERALS = [
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'\$\d+|%\(\w+\)s|(?<!:):\w+'), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)'), '(?, ...)'),
+    (re.compile(r'(\(\?, \.\.\.\))(?:\s*,\s*\(\?, \.\.\.\))+'), r'\1, ...'),  # noqa: E501
+    (re.compile(r'\s+'), ' '),
+]
+
+
+def normalize_sql(statement: str) -> str:
+    """
+    Statement with literals and placeholders replaced by ``?`` and lists
+    of them collapsed, so that the same query always reads the same.
+    """
+    for pattern, replacement in _LITERALS:
+        statement = pattern.sub(replacement, statement)
+    return statement.strip()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):  # noqa: E501
+    context.query_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):  # noqa: E501
+    elapsed = time.perf_counter() - context.query_start
+    query_metrics.statements += 1
+    query_metrics.seconds += elapsed
+
+    stats = request_stats.get()
+    if stats is not None:
+        stats.statements += 1
+        stats.db_time += elapsed
+        if elapsed > stats.slowest_time:
+            stats.slowest_time = elapsed
+            stats.slowest_statement = statement
+
+    if DB_SLOW_QUERY_MS and elapsed * 1000 >= DB_SLOW_QUERY_MS:
+        query_metrics.slow += 1
+        slow_query_logger.warning(
+            '%.1f ms: %s',
+            elapsed * 1000,
+            normalize_sql(statement),
+        )
+
+
+class PoolMetrics:
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record_wait(self, seconds: float):
+        self.checkouts += 1
+        self.wait_total += seconds
+        self.wait_max = max(self.wait_max, seconds)
+
+
+class MeteredPool(AsyncAdaptedQueuePool):
+    """
+    Queue pool that records how long checkouts wait for a connection,
+    including the time to open a new one, and how many of them time out.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+
+    def recreate(self) -> 'MeteredPool':
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            self.metrics.timeouts += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            self.metrics.record_wait(elapsed)
+            stats = request_stats.get()
+            if stats is not None:
+                stats.pool_wait += elapsed
+
+
+def build_engine(url: str) -> AsyncEngine:
+    url = make_url(url)
+    kwargs = {}
+    if url.get_backend_name() != 'sqlite' or url.database not in (None, '', ':memory:'):  # noqa: E501
+        kwargs.update(
+            poolclass=MeteredPool,
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_recycle=DB_POOL_RECYCLE,
+            pool_pre_ping=DB_POOL_PRE_PING,
+        )
+    if url.get_driver_name() == 'asyncpg':
+        connect_args = {
+            'prepared_statement_cache_size': DB_STATEMENT_CACHE_SIZE,
+        }
+        if DB_STATEMENT_TIMEOUT:
+            connect_args['server_settings'] = {
+                'statement_timeout': str(DB_STATEMENT_TIMEOUT),
+            }
+        kwargs['connect_args'] = connect_args
+    engine = create_async_engine(url, **kwargs)
+    event.listen(
+        engine.sync_engine,
+        'before_cursor_execute',
+        _before_cursor_execute,
+    )
+    event.listen(
+        engine.sync_engine,
+        'after_cursor_execute',
+        _after_cursor_execute,
+    )
+    return engine
+
+
+def pool_stats(engine: AsyncEngine) -> dict:
+    pool = engine.pool
+    stats = {'status': pool.status()}
+    if isinstance(pool, MeteredPool):
+        metrics = pool.metrics
+        stats.update(
+            size=pool.size(),
+            checked_out=pool.checkedout(),
+            overflow=pool.overflow(),
+            checkouts=metrics.checkouts,
+            timeouts=metrics.timeouts,
+            wait_total=metrics.wait_total,
+            wait_max=metrics.wait_max,
+        )
+    return stats
+
+
+engine = build_engine(DATABASE_URL)
 async_session_maker = async_sessionmaker(engine, expire_on_commit=False)
 
+# Read-only GET endpoints may be served by a replica, falls back to primary
+read_engine = engine
+if DATABASE_REPLICA_URL:
+    read_engine = build_engine(DATABASE_REPLICA_URL)
+read_session_maker = async_sessionmaker(read_engine, expire_on_commit=False)
+
 
 async def get_async_session() -> AsyncGenerator[AsyncSession, None]:
     async with async_session_maker() as session:
         yield session
 
 
+async def get_read_session() -> AsyncGenerator[AsyncSession, None]:
+    async with read_session_maker() as session:
+        yield session
+
+
 async def get_user_db(session: AsyncSession = Depends(get_async_session)):
     yield SQLAlchemyUserDatabase(session, User, OAuthAccount)
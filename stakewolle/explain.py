@@ -0,0 +1,127 @@
+"""
+Check that the referral endpoints are served by index scans.
+
+Runs EXPLAIN for the queries of stakewolle/routers/referral.py against
+DATABASE_URL and exits with 1 if any of them scans a whole table.
+Sequential scans are disabled for the check, since the planner prefers
+them on small tables whether an index exists or not.
+
+Usage: python -m stakewolle.explain
+"""
+import asyncio
+import sys
+
+import datetime
+
+from sqlalchemy import Select, text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from stakewolle.engine import engine
+from stakewolle.queries import (
+    referral_by_email,
+    referral_by_user_id,
+    referral_leaderboard,
+    referral_stats_by_referrer_id,
+    referrals_by_referrer_id,
+)
+from stakewolle.referral_stats import windows
+
+
+SINCE_24H, SINCE_7D = windows(datetime.datetime(2024, 1, 1))
+QUERIES = {
+    '/referral/get_by_email/': referral_by_email('explain@example.com'),
+    '/referral/get_my_referral/': referral_by_user_id(1),
+    '/referral/get_referrals_by_referrer_id/{id}/': (
+        referrals_by_referrer_id(1, after=0).limit(100)
+    ),
+    '/referral/get_referrals_by_referrer_id/{id}/?stream=true': (
+        referrals_by_referrer_id(1)
+    ),
+    '/referral/stats/{id}/': (
+        referral_stats_by_referrer_id(1, SINCE_24H, SINCE_7D)
+    ),
+    '/referral/leaderboard/': (
+        referral_leaderboard(10, SINCE_24H, SINCE_7D)
+    ),
+    '/referral/leaderboard/?period=7d': (
+        referral_leaderboard(10, SINCE_24H, SINCE_7D, period='7d')
+    ),
+}
+# Tables a query may read whole in index order on SQLite (SCAN ... USING
+# INDEX), any other full scan fails the check. The leaderboard walks
+# ix_referral_stats_total backwards and stops at LIMIT, the windowed one
+# sums every bucket of the window from referral_stats_hourly, which
+# keeps only the last week, in primary key order to group by referrer
+INDEX_WALKS = {
+    '/referral/leaderboard/': {'referral_stats'},
+    '/referral/leaderboard/?period=7d': {'referral_stats_hourly'},
+}
+
+
+def _compile(conn: AsyncConnection, query: Select) -> str:
+    return str(query.compile(
+        dialect=conn.dialect,
+        compile_kwargs={'literal_binds': True},
+    ))
+
+
+def _postgres_seq_scans(plan: dict) -> list:
+    scans = []
+    if plan['Node Type'] == 'Seq Scan':
+        scans.append(plan['Relation Name'])
+    for subplan in plan.get('Plans', []):
+        scans.extend(_postgres_seq_scans(subplan))
+    return scans
+
+
+async def full_scans(
+    conn: AsyncConnection,
+    query: Select,
+    index_walks: frozenset = frozenset(),
+) -> list:
+    """
+    :param index_walks: Tables the query may scan in index order.
+    :return: Names of the tables the query reads with a full scan.
+    """
+    sql = _compile(conn, query)
+    if conn.dialect.name == 'postgresql':
+        result = await conn.execute(text(f'EXPLAIN (FORMAT JSON) {sql}'))
+        return _postgres_seq_scans(result.scalar()[0]['Plan'])
+    if conn.dialect.name == 'sqlite':
+        result = await conn.execute(text(f'EXPLAIN QUERY PLAN {sql}'))
+        details = [row.detail.split() for row in result]
+        # Subqueries are read as they are produced, they are not tables
+        subqueries = {
+            detail[1] for detail in details
+            if detail[0] in ('CO-ROUTINE', 'MATERIALIZE')
+        }
+        return [
+            detail[1] for detail in details
+            if detail[0] == 'SCAN' and detail[1] not in subqueries
+            and not ('USING' in detail and detail[1] in index_walks)
+        ]
+    raise NotImplementedError(conn.dialect.name)
+
+
+async def main() -> int:
+    failed = False
+    async with engine.connect() as conn:
+        if conn.dialect.name == 'postgresql':
+            await conn.execute(text('SET enable_seqscan = off'))
+        for endpoint, query in QUERIES.items():
+            scans = await full_scans(
+                conn,
+                query,
+                frozenset(INDEX_WALKS.get(endpoint, ())),
+            )
+            if scans:
+                failed = True
+                print(f'FAIL {endpoint}: full scan of {", ".join(scans)}')
+            else:
+                print(f'OK   {endpoint}')
+    await engine.dispose()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,84 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable
+
+from dotenv import load_dotenv
+from fastapi import HTTPException
+
+
+load_dotenv()
+PASSWORD_HASH_WORKERS = int(
+    os.getenv('PASSWORD_HASH_WORKERS', min(4, os.cpu_count() or 1)),
+)
+PASSWORD_HASH_QUEUE = int(os.getenv('PASSWORD_HASH_QUEUE', 64))
+
+
+class PasswordHashPool:
+    """
+    Runs password hashing and verification off the event loop.
+
+    bcrypt and argon2 release the GIL, so a small thread pool keeps the
+    worker responsive during signup and login bursts. At most ``workers``
+    hashes run at once and ``queue_limit`` more may wait; beyond that
+    requests are shed with 503 instead of piling up.
+    """
+
+    def __init__(self, workers: int, queue_limit: int):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers,
+            thread_name_prefix='password-hash',
+        )
+
+    async def run(self, func: Callable, *args) -> Any:
+        if self.in_flight >= self.workers + self.queue_limit:
+            self.rejected += 1
+            raise HTTPException(
+                503,
+                'Server is busy, try again later',
+                headers={'Retry-After': '1'},
+            )
+        self.in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor,
+                func,
+                *args,
+            )
+        finally:
+            self.in_flight -= 1
+            self.completed += 1
+
+    async def map(self, func: Callable, items: Iterable) -> list:
+        """
+        Run func over items, at most ``workers`` at a time, so a bulk job
+        leaves the queue to interactive requests.
+        """
+        semaphore = asyncio.Semaphore(self.workers)
+
+        async def run_one(item):
+            async with semaphore:
+                return await self.run(func, item)
+
+        return await asyncio.gather(*[run_one(item) for item in items])
+
+    def stats(self) -> dict:
+        return {
+            'workers': self.workers,
+            'queue_limit': self.queue_limit,
+            'running': min(self.in_flight, self.workers),
+            'queued': max(self.in_flight - self.workers, 0),
+            'completed': self.completed,
+            'rejected': self.rejected,
+        }
+
+
+password_hash_pool = PasswordHashPool(
+    PASSWORD_HASH_WORKERS,
+    PASSWORD_HASH_QUEUE,
+)
@@ -0,0 +1,256 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import tempfile
+import uuid
+from typing import Callable
+
+from dotenv import load_dotenv
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from stakewolle.engine import engine
+
+
+load_dotenv()
+INVALIDATION_BACKEND = os.getenv('INVALIDATION_BACKEND', '')
+INVALIDATION_CHANNEL = os.getenv(
+    'INVALIDATION_CHANNEL',
+    'stakewolle_invalidation',
+)
+INVALIDATION_SOCKET_DIR = os.getenv(
+    'INVALIDATION_SOCKET_DIR',
+    os.path.join(tempfile.gettempdir(), 'stakewolle-invalidation'),
+)
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[[dict], None]
+
+
+class InvalidationBus:
+    """
+    Fans cache invalidation messages out to every worker process.
+
+    A message is a dict with a ``kind`` ('referral', 'user', ...) and the
+    keys to drop. ``publish`` applies it to the local process right away
+    and then broadcasts it to the other workers through the backend.
+    Handlers subscribed to 'reset' are called when the backend may have
+    lost messages, so subscribers should drop everything they hold.
+
+    This base class is the in-process backend for a single worker.
+    """
+
+    def __init__(self):
+        self.instance_id = uuid.uuid4().hex
+        self._handlers: dict[str, list[Handler]] = {}
+
+    def subscribe(self, kind: str, handler: Handler):
+        self._handlers.setdefault(kind, []).append(handler)
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def publish(self, kind: str, **keys):
+        """
+        Publish after the write was committed, otherwise another request
+        can cache the old row again before the commit lands.
+
+        :param kind: Kind of the invalidated object.
+        :param keys: Keys of the invalidated object, must be JSON-safe.
+        """
+        message = {'kind': kind, **keys}
+        self.dispatch(message)
+        try:
+            await self._broadcast(
+                {**message, 'sender': self.instance_id},
+            )
+        except Exception:
+            # The write itself is committed, peers fall back to the TTL
+            logger.exception('Failed to broadcast invalidation %s', message)
+
+    def dispatch(self, message: dict):
+        for handler in self._handlers.get(message.get('kind'), []):
+            try:
+                handler(message)
+            except Exception:
+                logger.exception('Invalidation handler failed: %s', message)
+
+    def reset(self):
+        self.dispatch({'kind': 'reset'})
+
+    async def _broadcast(self, message: dict):
+        pass
+
+    def _receive(self, payload):
+        try:
+            message = json.loads(payload)
+        except ValueError:
+            logger.warning('Malformed invalidation message: %r', payload)
+            return
+        if message.get('sender') != self.instance_id:
+            self.dispatch(message)
+
+
+class UnixSocketInvalidationBus(InvalidationBus):
+    """
+    Broadcasts over Unix datagram sockets, one per worker, all bound in
+    a shared directory. Works for workers of one host without any external
+    service.
+    """
+
+    def __init__(self, directory: str):
+        super().__init__()
+        self.directory = directory
+        self.path = os.path.join(directory, f'{self.instance_id}.sock')
+        self._sock = None
+
+    async def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.bind(self.path)
+        self._sock.setblocking(False)
+        asyncio.get_running_loop().add_reader(
+            self._sock.fileno(),
+            self._on_readable,
+        )
+
+    async def stop(self):
+        if self._sock is None:
+            return
+        asyncio.get_running_loop().remove_reader(self._sock.fileno())
+        self._sock.close()
+        self._sock = None
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    async def _broadcast(self, message: dict):
+        if self._sock is None:
+            return
+        data = json.dumps(message).encode()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if path == self.path or not name.endswith('.sock'):
+                continue
+            try:
+                self._sock.sendto(data, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Socket of a dead worker, nobody is reading it anymore
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+            except BlockingIOError:
+                logger.warning('Invalidation queue of %s is full', path)
+
+    def _on_readable(self):
+        while True:
+            try:
+                data = self._sock.recv(65536)
+            except BlockingIOError:
+                return
+            self._receive(data)
+
+
+class PostgresInvalidationBus(InvalidationBus):
+    """
+    Broadcasts with LISTEN/NOTIFY through the application engine.
+
+    Every worker keeps one connection LISTENing on the channel and sends
+    its own NOTIFYs over it. When that connection drops the subscribers
+    are reset, since notifications sent in the meantime are lost.
+    """
+
+    reconnect_delay = 1.0
+
+    def __init__(self, engine: AsyncEngine, channel: str):
+        super().__init__()
+        self.engine = engine
+        self.channel = channel
+        self._connection = None
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _listen(self):
+        while True:
+            try:
+                async with self.engine.connect() as conn:
+                    raw_connection = await conn.get_raw_connection()
+                    connection = raw_connection.driver_connection
+                    closed = asyncio.Event()
+                    connection.add_termination_listener(
+                        lambda _: closed.set(),
+                    )
+                    await connection.add_listener(
+                        self.channel,
+                        self._on_notify,
+                    )
+                    self._connection = connection
+                    try:
+                        await closed.wait()
+                    finally:
+                        self._connection = None
+                        if not connection.is_closed():
+                            await connection.remove_listener(
+                                self.channel,
+                                self._on_notify,
+                            )
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Invalidation listener failed')
+            self.reset()
+            await asyncio.sleep(self.reconnect_delay)
+
+    async def _broadcast(self, message: dict):
+        payload = json.dumps(message)
+        if self._connection is not None:
+            async with self._lock:
+                await self._connection.execute(
+                    'SELECT pg_notify($1, $2)',
+                    self.channel,
+                    payload,
+                )
+            return
+        async with self.engine.begin() as conn:
+            await conn.execute(select(func.pg_notify(self.channel, payload)))
+
+    def _on_notify(self, connection, pid, channel, payload):
+        self._receive(payload)
+
+
+def create_invalidation_bus() -> InvalidationBus:
+    backend = INVALIDATION_BACKEND
+    if not backend:
+        backend = 'postgres' if engine.dialect.name == 'postgresql' else 'local'  # noqa: E501
+
+    if backend == 'postgres':
+        return PostgresInvalidationBus(engine, INVALIDATION_CHANNEL)
+    if backend == 'unix':
+        return UnixSocketInvalidationBus(INVALIDATION_SOCKET_DIR)
+    if backend == 'local':
+        return InvalidationBus()
+    raise ValueError(f'Unknown INVALIDATION_BACKEND: {backend}')
+
+
+invalidation_bus = create_invalidation_bus()
@@ -0,0 +1,431 @@
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import time
+from typing import Iterable
+
+from dotenv import load_dotenv
+from starlette.datastructures import MutableHeaders
+
+from stakewolle.cache import referral_cache, revoked_users, user_cache
+from stakewolle.engine import (
+    MeteredPool,
+    RequestStats,
+    engine,
+    normalize_sql,
+    query_metrics,
+    read_engine,
+    request_stats,
+)
+from stakewolle.hashing import password_hash_pool
+
+
+load_dotenv()
+# Adds the X-DB-* headers with the database work of every response
+DEBUG = os.getenv('DEBUG', 'false').lower() == 'true'
+# Workers of one host share their metrics through snapshots in this
+# directory, written every METRICS_INTERVAL seconds
+METRICS_DIR = os.getenv(
+    'METRICS_DIR',
+    os.path.join(tempfile.gettempdir(), 'stakewolle-metrics'),
+)
+METRICS_INTERVAL = float(os.getenv('METRICS_INTERVAL', 1))
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class RouteMetrics:
+    def __init__(self):
+        self.buckets = [0] * len(DURATION_BUCKETS)
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = 0
+        self.statements_max = 0
+        self.db_seconds = 0.0
+        self.pool_wait = 0.0
+
+    def observe(self, seconds: float, stats: RequestStats):
+        for i, bound in enumerate(DURATION_BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+        self.count += 1
+        self.seconds += seconds
+        self.statements += stats.statements
+        self.statements_max = max(self.statements_max, stats.statements)
+        self.db_seconds += stats.db_time
+        self.pool_wait += stats.pool_wait
+
+
+class HttpMetrics:
+    """
+    Request counters of this worker process, labelled by route template
+    rather than by path to keep the number of series bounded.
+    """
+
+    def __init__(self):
+        # (method, route, status) -> requests
+        self.responses: dict[tuple, int] = {}
+        # (method, route) -> RouteMetrics
+        self.routes: dict[tuple, RouteMetrics] = {}
+
+    def observe(
+        self,
+        method: str,
+        route: str,
+        status: int,
+        seconds: float,
+        stats: RequestStats,
+    ):
+        key = (method, route, status)
+        self.responses[key] = self.responses.get(key, 0) + 1
+        metrics = self.routes.get((method, route))
+        if metrics is None:
+            metrics = self.routes[(method, route)] = RouteMetrics()
+        metrics.observe(seconds, stats)
+
+
+http_metrics = HttpMetrics()
+
+
+class RequestMetricsMiddleware:
+    """
+    Collects the statements, database time and pool wait of every request
+    through engine.request_stats and records them in http_metrics.
+
+    Work done after the response has started, like streamed bodies,
+    is not included in the X-DB-* headers.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = request_stats.set(stats)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_stats(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                if DEBUG:
+                    headers = MutableHeaders(scope=message)
+                    headers['X-DB-Statements'] = str(stats.statements)
+                    headers['X-DB-Time-Ms'] = f'{stats.db_time * 1000:.2f}'
+                    headers['X-DB-Pool-Wait-Ms'] = f'{stats.pool_wait * 1000:.2f}'  # noqa: E501
+                    headers['X-DB-Slowest-Ms'] = f'{stats.slowest_time * 1000:.2f}'  # noqa: E501
+                    if stats.slowest_statement is not None:
+                        # Header values are one line
+                        headers['X-DB-Slowest-Statement'] = ' '.join(
+                            normalize_sql(stats.slowest_statement).split(),
+                        )
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_stats)
+        finally:
+            request_stats.reset(token)
+            http_metrics.observe(
+                scope['method'],
+                _route_label(scope),
+                status,
+                time.perf_counter() - start,
+                stats,
+            )
+
+
+def _route_label(scope) -> str:
+    """
+    Path of the matched route with its parameters as placeholders,
+    like /referral/get_referrals_by_referrer_id/{id}/
+    """
+    if 'route' not in scope:
+        return 'unmatched'
+    params = {
+        str(value): f'{{{name}}}'
+        for name, value in scope.get('path_params', {}).items()
+    }
+    return '/'.join(
+        params.get(segment, segment)
+        for segment in scope['path'].split('/')
+    )
+
+
+def _labels(**labels) -> str:
+    if not labels:
+        return ''
+    pairs = []
+    for name, value in labels.items():
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+def _metric(name: str, kind: str, samples: Iterable[tuple]) -> list:
+    """
+    :param samples: Labels and value of every sample.
+    :return: A list with the family of the metric: its name, kind and
+    samples as (sample name, labels, value).
+    """
+    return [(name, kind, [
+        (name, labels, value) for labels, value in samples
+    ])]
+
+
+def _http_families() -> list:
+    routes = http_metrics.routes.items()
+    buckets = []
+    for (method, route), metrics in routes:
+        for bound, count in zip(DURATION_BUCKETS, metrics.buckets):
+            buckets.append(
+                ({'method': method, 'route': route, 'le': bound}, count),
+            )
+        buckets.append(
+            ({'method': method, 'route': route, 'le': '+Inf'}, metrics.count),
+        )
+
+    def per_route(attribute: str) -> list:
+        return [
+            ({'method': method, 'route': route}, getattr(metrics, attribute))
+            for (method, route), metrics in routes
+        ]
+
+    families = _metric('stakewolle_http_requests_total', 'counter', [
+        ({'method': method, 'route': route, 'status': status}, count)
+        for (method, route, status), count in http_metrics.responses.items()
+    ])
+    name = 'stakewolle_http_request_duration_seconds'
+    families.append((name, 'histogram', [
+        *[(f'{name}_bucket', labels, value) for labels, value in buckets],
+        *[(f'{name}_sum', labels, value) for labels, value in per_route('seconds')],  # noqa: E501
+        *[(f'{name}_count', labels, value) for labels, value in per_route('count')],  # noqa: E501
+    ]))
+    families += _metric(
+        'stakewolle_http_db_statements_total',
+        'counter',
+        per_route('statements'),
+    )
+    families += _metric(
+        'stakewolle_http_db_statements_max',
+        'gauge',
+        per_route('statements_max'),
+    )
+    families += _metric(
+        'stakewolle_http_db_seconds_total',
+        'counter',
+        per_route('db_seconds'),
+    )
+    families += _metric(
+        'stakewolle_http_db_pool_wait_seconds_total',
+        'counter',
+        per_route('pool_wait'),
+    )
+    return families
+
+
+def _db_families() -> list:
+    families = _metric('stakewolle_db_statements_total', 'counter', [
+        ({}, query_metrics.statements),
+    ])
+    families += _metric('stakewolle_db_seconds_total', 'counter', [
+        ({}, query_metrics.seconds),
+    ])
+    families += _metric('stakewolle_db_slow_statements_total', 'counter', [
+        ({}, query_metrics.slow),
+    ])
+
+    pools = {'database': engine.pool}
+    if read_engine is not engine:
+        pools['replica'] = read_engine.pool
+    pools = {
+        name: pool for name, pool in pools.items()
+        if isinstance(pool, MeteredPool)
+    }
+    for name, kind, value in (
+        ('size', 'gauge', lambda pool: pool.size()),
+        ('checked_out', 'gauge', lambda pool: pool.checkedout()),
+        ('overflow', 'gauge', lambda pool: pool.overflow()),
+        ('checkouts_total', 'counter', lambda pool: pool.metrics.checkouts),
+        ('timeouts_total', 'counter', lambda pool: pool.metrics.timeouts),
+        ('wait_seconds_total', 'counter', lambda pool: pool.metrics.wait_total),  # noqa: E501
+        ('wait_seconds_max', 'gauge', lambda pool: pool.metrics.wait_max),
+    ):
+        families += _metric(f'stakewolle_db_pool_{name}', kind, [
+            ({'database': database}, value(pool))
+            for database, pool in pools.items()
+        ])
+    return families
+
+
+def _stats_families(
+    prefix: str,
+    label: str,
+    stats: dict,
+    counters: set,
+) -> list:
+    """
+    :param stats: label value -> stats() of one object
+    :param counters: Keys of the stats that only grow
+    """
+    families = []
+    keys = next(iter(stats.values())).keys()
+    for key in keys:
+        if key in counters:
+            name, kind = f'{prefix}_{key}_total', 'counter'
+        else:
+            name, kind = f'{prefix}_{key}', 'gauge'
+        families += _metric(name, kind, [
+            ({label: value}, object_stats[key])
+            for value, object_stats in stats.items()
+        ])
+    return families
+
+
+def collect_metrics() -> list:
+    """
+    :return: Metric families of this worker process, see _metric.
+    """
+    families = _http_families() + _db_families()
+    families += _stats_families(
+        'stakewolle_cache',
+        'cache',
+        {
+            'referral': referral_cache.stats(),
+            'user': user_cache.stats(),
+        },
+        {'hits', 'misses', 'evictions'},
+    )
+    families += _stats_families(
+        'stakewolle_revoked_users',
+        'list',
+        {'default': revoked_users.stats()},
+        {'revocations', 'expirations'},
+    )
+    families += _stats_families(
+        'stakewolle_password_hash',
+        'pool',
+        {'default': password_hash_pool.stats()},
+        {'completed', 'rejected'},
+    )
+    return families
+
+
+class WorkerMetrics:
+    """
+    Shares the metrics of this worker with the other workers of the host,
+    so that /metrics answers for all of them whichever worker the scrape
+    lands on.
+
+    Every worker writes a snapshot of its metrics to a file named after
+    its pid in a shared directory every ``interval`` seconds. Samples are
+    rendered with a ``worker`` label, so that the counters of each worker
+    stay one series, e.g. sum by (route) (rate(...[5m])) across workers.
+    Snapshots not refreshed for ``10 * interval`` seconds, left by workers
+    that died, are skipped and removed.
+    """
+
+    def __init__(self, directory: str, interval: float):
+        self.directory = directory
+        self.interval = interval
+        self.worker = None
+        self._task = None
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.directory, f'{self.worker}.json')
+
+    async def start(self):
+        # Workers are forked after import, the pid is known only here
+        self.worker = str(os.getpid())
+        os.makedirs(self.directory, exist_ok=True)
+        self.write()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def write(self):
+        # Written aside and renamed, readers never see a partial file
+        temporary = f'{self.path}.tmp'
+        with open(temporary, 'w') as file:
+            json.dump(collect_metrics(), file)
+        os.replace(temporary, self.path)
+
+    def render(self) -> str:
+        """
+        Metrics of every worker in the Prometheus text format.
+        """
+        workers = {self.worker or str(os.getpid()): collect_metrics()}
+        if self.worker is not None:
+            workers.update(self._read_others())
+
+        kinds = {}
+        samples = {}
+        for worker, families in sorted(workers.items()):
+            for name, kind, family_samples in families:
+                kinds.setdefault(name, kind)
+                samples.setdefault(name, []).extend(
+                    (sample, {'worker': worker, **labels}, value)
+                    for sample, labels, value in family_samples
+                )
+        lines = []
+        for name, kind in kinds.items():
+            lines.append(f'# TYPE {name} {kind}')
+            lines += [
+                f'{sample}{_labels(**labels)} {value}'
+                for sample, labels, value in samples[name]
+            ]
+        return '\n'.join(lines) + '\n'
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.write()
+            except OSError:
+                logger.exception('Failed to write the metrics snapshot')
+
+    def _read_others(self) -> dict:
+        workers = {}
+        oldest = time.time() - 10 * self.interval
+        for name in os.listdir(self.directory):
+            worker, extension = os.path.splitext(name)
+            if extension != '.json' or worker == self.worker:
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) < oldest:
+                    # Left by a worker that died, a live one writes it again
+                    os.remove(path)
+                    continue
+                with open(path) as file:
+                    workers[worker] = json.load(file)
+            except (OSError, ValueError):
+                # Removed by a worker shutting down meanwhile
+                continue
+        return workers
+
+
+worker_metrics = WorkerMetrics(METRICS_DIR, METRICS_INTERVAL)
+
+
+def render_metrics() -> str:
+    """
+    Metrics of every worker process in the Prometheus text format.
+    """
+    return worker_metrics.render()
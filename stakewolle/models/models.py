@@ -6,7 +6,15 @@ from fastapi_users.db import (
     SQLAlchemyBaseUserTable,
 )
 from sqlalchemy.orm import relationship, Mapped, mapped_column, DeclarativeBase
-from sqlalchemy import ForeignKey, DateTime, Boolean, String
+from sqlalchemy import (
+    ForeignKey,
+    DateTime,
+    Boolean,
+    Index,
+    Integer,
+    String,
+    func,
+)
 from sqlalchemy.ext.declarative import declared_attr
 
 
@@ -27,10 +35,11 @@ class Referral(Base):
     )
     created_at: Mapped[DateTime] = mapped_column(
         DateTime(timezone=True),
-        default=datetime.datetime.now(datetime.timezone.utc),
+        default=lambda: datetime.datetime.now(datetime.timezone.utc),
     )
     expires_at: Mapped[DateTime] = mapped_column(
         DateTime(timezone=True),
+        index=True,
     )
     user_id: Mapped[int] = mapped_column(
         ForeignKey('user.id'),
@@ -53,6 +62,15 @@ class OAuthAccount(SQLAlchemyBaseOAuthAccountTable[int], Base):
 
 
 class User(SQLAlchemyBaseUserTable[int], Base):
+    __table_args__ = (
+        # Covers the referrer -> referrals listing, keyset-paginated by id
+        Index(
+            'ix_user_referral_name_id',
+            'referral_name',
+            'id',
+            postgresql_include=['username'],
+        ),
+    )
 
     id: Mapped[int] = mapped_column(
         primary_key=True,
@@ -83,7 +101,7 @@ class User(SQLAlchemyBaseUserTable[int], Base):
     )
     registered_at: Mapped[DateTime] = mapped_column(
         DateTime(timezone=True),
-        default=datetime.datetime.now(datetime.timezone.utc),
+        default=lambda: datetime.datetime.now(datetime.timezone.utc),
     )
     is_active: Mapped[bool] = mapped_column(
         Boolean,
@@ -104,3 +122,57 @@ class User(SQLAlchemyBaseUserTable[int], Base):
         'OAuthAccount',
         lazy='joined',
     )
+
+
+# fastapi-users looks users up by lower(email)
+Index('ix_user_email_lower', func.lower(User.email))
+
+
+class ReferralStats(Base):
+    """
+    Referral counters of a referrer, kept up to date by UserManager
+    and recomputed by stakewolle.referral_stats.
+    """
+
+    __tablename__ = 'referral_stats'
+    __table_args__ = (
+        # Leaderboard, read backwards
+        Index('ix_referral_stats_total', 'total', 'referrer_id'),
+    )
+
+    referrer_id: Mapped[int] = mapped_column(
+        ForeignKey('user.id', ondelete='cascade'),
+        primary_key=True,
+    )
+    total: Mapped[int] = mapped_column(
+        Integer,
+        nullable=False,
+        default=0,
+    )
+    last_signup_at: Mapped[DateTime] = mapped_column(
+        DateTime(timezone=True),
+        nullable=True,
+    )
+
+
+class ReferralStatsHourly(Base):
+    """
+    Referrals of a referrer per hour (UTC) of the last week, the 24 h and
+    7 d counters are sums of these.
+    """
+
+    __tablename__ = 'referral_stats_hourly'
+
+    referrer_id: Mapped[int] = mapped_column(
+        ForeignKey('user.id', ondelete='cascade'),
+        primary_key=True,
+    )
+    hour: Mapped[DateTime] = mapped_column(
+        DateTime(timezone=True),
+        primary_key=True,
+        index=True,
+    )
+    count: Mapped[int] = mapped_column(
+        Integer,
+        nullable=False,
+    )
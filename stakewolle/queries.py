@@ -0,0 +1,195 @@
+import datetime
+from typing import Iterable, Literal, Optional
+
+from sqlalchemy import Select, Table, and_, case, func, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.sql.dml import Insert
+
+from stakewolle.models.models import (
+    User,
+    Referral,
+    ReferralStats,
+    ReferralStatsHourly,
+)
+
+
+def referral_by_email(email: str) -> Select:
+    return (
+        select(Referral.referral, Referral.user_id, Referral.expires_at).
+        join(User, Referral.user_id == User.id).
+        where(User.email == email)
+    )
+
+
+def referral_by_user_id(user_id: int) -> Select:
+    return (
+        select(Referral.referral, Referral.user_id, Referral.expires_at).
+        where(Referral.user_id == user_id)
+    )
+
+
+def referrals_by_referrer_id(
+    referrer_id: int,
+    after: Optional[int] = None,
+) -> Select:
+    query = (
+        select(User.id, User.username).
+        join(Referral, User.referral_name == Referral.referral).
+        where(Referral.user_id == referrer_id).
+        order_by(User.id)
+    )
+    if after is not None:
+        query = query.where(User.id > after)
+    return query
+
+
+def referrals_by_codes(codes: Iterable[str]) -> Select:
+    return (
+        select(Referral.referral, Referral.expires_at, Referral.user_id).
+        where(Referral.referral.in_(list(codes)))
+    )
+
+
+def users_by_emails(emails: Iterable[str]) -> Select:
+    """
+    :param emails: Lowercased emails, matched like fastapi-users does.
+    """
+    return (
+        select(func.lower(User.email)).
+        where(func.lower(User.email).in_(list(emails)))
+    )
+
+
+def dialect_insert(table: Table, dialect: str) -> Insert:
+    """
+    INSERT supporting ON CONFLICT for the given dialect name.
+    """
+    if dialect == 'postgresql':
+        return postgresql.insert(table)
+    if dialect == 'sqlite':
+        return sqlite.insert(table)
+    raise NotImplementedError(dialect)
+
+
+def insert_ignoring_conflicts(table: Table, dialect: str) -> Insert:
+    """
+    INSERT ... ON CONFLICT DO NOTHING for the given dialect name.
+    """
+    return dialect_insert(table, dialect).on_conflict_do_nothing()
+
+
+def _windowed_referral_stats(
+    referrer_id,
+    since_24h: datetime.datetime,
+    since_7d: datetime.datetime,
+) -> Select:
+    """
+    Counters of the referrer_id column joined with the sums of
+    its hourly buckets, to be completed with FROM and GROUP BY.
+    """
+    return (
+        select(
+            referrer_id.label('referrer_id'),
+            ReferralStats.total,
+            func.coalesce(func.sum(case(
+                (ReferralStatsHourly.hour >= since_24h,
+                 ReferralStatsHourly.count),
+                else_=0,
+            )), 0).label('last_24h'),
+            func.coalesce(
+                func.sum(ReferralStatsHourly.count),
+                0,
+            ).label('last_7d'),
+            ReferralStats.last_signup_at,
+        ).
+        outerjoin(ReferralStatsHourly, and_(
+            ReferralStatsHourly.referrer_id == referrer_id,
+            ReferralStatsHourly.hour >= since_7d,
+        ))
+    )
+
+
+def referral_stats_by_referrer_id(
+    referrer_id: int,
+    since_24h: datetime.datetime,
+    since_7d: datetime.datetime,
+) -> Select:
+    """
+    :param since_24h: First hourly bucket of the last 24 hours.
+    :param since_7d: First hourly bucket of the last 7 days.
+    """
+    return (
+        _windowed_referral_stats(
+            ReferralStats.referrer_id,
+            since_24h,
+            since_7d,
+        ).
+        where(ReferralStats.referrer_id == referrer_id).
+        group_by(
+            ReferralStats.referrer_id,
+            ReferralStats.total,
+            ReferralStats.last_signup_at,
+        )
+    )
+
+
+def referral_leaderboard(
+    limit: int,
+    since_24h: datetime.datetime,
+    since_7d: datetime.datetime,
+    period: Literal['all', '7d', '24h'] = 'all',
+) -> Select:
+    """
+    Top referrers by total referrals, or by referrals of the last
+    24 hours / 7 days, with their counters and usernames.
+    """
+    if period == 'all':
+        score = ReferralStats.total
+        ranked = select(ReferralStats.referrer_id, score.label('score'))
+    else:
+        score = func.sum(ReferralStatsHourly.count)
+        ranked = (
+            select(ReferralStatsHourly.referrer_id, score.label('score')).
+            where(ReferralStatsHourly.hour >= (
+                since_24h if period == '24h' else since_7d
+            )).
+            group_by(ReferralStatsHourly.referrer_id)
+        )
+    ranked = (
+        ranked.
+        order_by(score.desc(), ranked.selected_columns.referrer_id.desc()).
+        limit(limit).
+        subquery()
+    )
+    return (
+        _windowed_referral_stats(ranked.c.referrer_id, since_24h, since_7d).
+        add_columns(User.username).
+        join(ReferralStats, ReferralStats.referrer_id == ranked.c.referrer_id).
+        join(User, User.id == ranked.c.referrer_id).
+        group_by(
+            ranked.c.referrer_id,
+            ranked.c.score,
+            ReferralStats.total,
+            ReferralStats.last_signup_at,
+            User.username,
+        ).
+        order_by(ranked.c.score.desc(), ranked.c.referrer_id.desc())
+    )
+
+
+def user_list(after: Optional[int] = None, with_email: bool = False) -> Select:
+    columns = [
+        User.id,
+        User.username,
+        User.referral_name,
+        User.registered_at,
+        User.is_active,
+        User.is_verified,
+        User.is_superuser,
+    ]
+    if with_email:
+        columns.insert(1, User.email)
+    query = select(*columns).order_by(User.id)
+    if after is not None:
+        query = query.where(User.id > after)
+    return query
@@ -0,0 +1,210 @@
+"""
+Materialized referral statistics per referrer.
+
+UserManager keeps referral_stats and referral_stats_hourly up to date as
+referred users register. Users deleted since, hourly buckets older than a
+week and anything changed by hand are reconciled by the rebuild
+job, run it after upgrading and then periodically, e.g. daily.
+
+Usage (rebuild): python -m stakewolle.referral_stats
+"""
+import asyncio
+import datetime
+import sys
+from collections import Counter
+from typing import Iterable, Optional
+
+import pytz
+from sqlalchemy import delete, func, insert, literal_column, select, text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession
+
+from stakewolle.engine import engine
+from stakewolle.models.models import (
+    Referral,
+    ReferralStats,
+    ReferralStatsHourly,
+    User,
+)
+from stakewolle.queries import dialect_insert
+
+
+HOUR = datetime.timedelta(hours=1)
+# Hourly buckets kept for the longest window, the last 7 days
+BUCKETS = 7 * 24
+
+
+def hour_of(moment: datetime.datetime) -> datetime.datetime:
+    """
+    :return: Start of the UTC hour of moment, its hourly bucket.
+    """
+    return moment.astimezone(pytz.utc).replace(
+        minute=0,
+        second=0,
+        microsecond=0,
+    )
+
+
+def windows(
+    now: Optional[datetime.datetime] = None,
+) -> tuple[datetime.datetime, datetime.datetime]:
+    """
+    :return: First buckets of the last 24 hours and of the last 7 days,
+    both windows include the current hour.
+    """
+    hour = hour_of(now or datetime.datetime.now(pytz.utc))
+    return hour - 23 * HOUR, hour - (BUCKETS - 1) * HOUR
+
+
+def hour_bucket(column, dialect: str):
+    """
+    SQL expression truncating column to its hourly bucket, stored the way
+    the dialect stores datetimes. Arguments are literals, so that the
+    expression can be repeated in GROUP BY.
+    """
+    if dialect == 'postgresql':
+        return func.date_trunc(
+            literal_column("'hour'"),
+            column,
+            literal_column("'UTC'"),
+        )
+    if dialect == 'sqlite':
+        return func.strftime(
+            literal_column("'%Y-%m-%d %H:00:00.000000'"),
+            column,
+        )
+    raise NotImplementedError(dialect)
+
+
+async def count_referrals(
+    session: AsyncSession,
+    signups: Iterable[tuple[int, datetime.datetime]],
+):
+    """
+    Add referred users to the counters of their referrers, on the
+    transaction of the session. The caller commits.
+
+    :param signups: Referrer id and registration time of every new user.
+    """
+    totals = Counter()
+    last_signups = {}
+    buckets = Counter()
+    for referrer_id, signed_up_at in signups:
+        # SQLite returns naive datetimes, they are stored in UTC
+        if signed_up_at.tzinfo is None:
+            signed_up_at = signed_up_at.replace(tzinfo=pytz.utc)
+        totals[referrer_id] += 1
+        last_signups[referrer_id] = max(
+            signed_up_at,
+            last_signups.get(referrer_id, signed_up_at),
+        )
+        buckets[(referrer_id, hour_of(signed_up_at))] += 1
+    if not totals:
+        return
+
+    dialect = session.get_bind().dialect.name
+    greatest = func.greatest if dialect == 'postgresql' else func.max
+    # Rows are locked in the same order by every transaction
+    statement = dialect_insert(ReferralStats.__table__, dialect)
+    await session.execute(
+        statement.
+        values([
+            {
+                'referrer_id': referrer_id,
+                'total': totals[referrer_id],
+                'last_signup_at': last_signups[referrer_id],
+            }
+            for referrer_id in sorted(totals)
+        ]).
+        on_conflict_do_update(
+            index_elements=['referrer_id'],
+            set_={
+                'total': ReferralStats.total + statement.excluded.total,
+                'last_signup_at': greatest(
+                    func.coalesce(
+                        ReferralStats.last_signup_at,
+                        statement.excluded.last_signup_at,
+                    ),
+                    statement.excluded.last_signup_at,
+                ),
+            },
+        ),
+    )
+    statement = dialect_insert(ReferralStatsHourly.__table__, dialect)
+    await session.execute(
+        statement.
+        values([
+            {'referrer_id': referrer_id, 'hour': hour, 'count': count}
+            for (referrer_id, hour), count in sorted(buckets.items())
+        ]).
+        on_conflict_do_update(
+            index_elements=['referrer_id', 'hour'],
+            set_={
+                'count': ReferralStatsHourly.count + statement.excluded.count,
+            },
+        ),
+    )
+
+
+async def rebuild(
+    conn: AsyncConnection,
+    now: Optional[datetime.datetime] = None,
+) -> tuple[int, int]:
+    """
+    Recompute both tables from the user table, on the transaction of conn.
+
+    On PostgreSQL the tables are locked first: registrations that already
+    counted their referral are waited for, later ones wait for the rebuild
+    and are then added on top of it.
+
+    :return: Number of referrers and of hourly buckets.
+    """
+    dialect = conn.dialect.name
+    if dialect == 'postgresql':
+        await conn.execute(text(
+            'LOCK TABLE referral_stats, referral_stats_hourly '
+            'IN EXCLUSIVE MODE',
+        ))
+    await conn.execute(delete(ReferralStatsHourly))
+    await conn.execute(delete(ReferralStats))
+
+    referrer_id = Referral.user_id.label('referrer_id')
+    referred = (
+        select(referrer_id).
+        join_from(User, Referral, User.referral_name == Referral.referral)
+    )
+    referrers = await conn.execute(
+        insert(ReferralStats).
+        from_select(
+            ['referrer_id', 'total', 'last_signup_at'],
+            referred.
+            add_columns(func.count(User.id), func.max(User.registered_at)).
+            group_by(Referral.user_id),
+        ),
+    )
+
+    hour = hour_bucket(User.registered_at, dialect)
+    _, since_7d = windows(now)
+    buckets = await conn.execute(
+        insert(ReferralStatsHourly).
+        from_select(
+            ['referrer_id', 'hour', 'count'],
+            referred.
+            add_columns(hour, func.count(User.id)).
+            where(User.registered_at >= since_7d).
+            group_by(Referral.user_id, hour),
+        ),
+    )
+    return referrers.rowcount, buckets.rowcount
+
+
+async def main() -> int:
+    async with engine.begin() as conn:
+        referrers, buckets = await rebuild(conn)
+    await engine.dispose()
+    print(f'Rebuilt referral stats: {referrers} referrers, '
+          f'{buckets} hourly buckets')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
@@ -1,12 +1,33 @@
-from fastapi import Depends, APIRouter, HTTPException
+from typing import Literal, Optional
+
+from fastapi import Depends, APIRouter, HTTPException, Query
+from fastapi.responses import StreamingResponse
 from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from stakewolle.backend import (
     current_active_user,
+    current_token_user,
+    TokenUser,
+)
+from stakewolle.cache import CachedReferral, MISSING, referral_cache
+from stakewolle.engine import (
+    get_async_session,
+    get_read_session,
+    read_session_maker,
 )
-from stakewolle.engine import async_session_maker, engine
+from stakewolle.invalidation import invalidation_bus
 from stakewolle.models.models import User, Referral
+from stakewolle.queries import (
+    referral_by_email,
+    referral_by_user_id,
+    referral_leaderboard,
+    referral_stats_by_referrer_id,
+    referrals_by_referrer_id,
+)
+from stakewolle.referral_stats import windows
 from stakewolle.schemas.referral import ReferralSchema
+from stakewolle.streaming import stream_ndjson
 from pydantic import EmailStr
 
 
@@ -14,77 +35,149 @@ router = APIRouter(prefix='/referral', tags=['referral'])
 
 
 @router.get('/get_by_email/')
-async def index(email: EmailStr):
-    async with engine.begin() as conn:
-        result = await conn.execute(
-            select(Referral.referral).
-            join(User, Referral.user_id == User.id).
-            where(User.email == email),
-        )
-        result = result.scalars().fetchall()
-        if result:
-            return {'referral': result}
-        return {'message': 'User has no referral'}
+async def index(
+    email: EmailStr,
+    # Misses fill the shared cache, a lagging replica would cache rows
+    # invalidated by a write that has not reached it yet
+    session: AsyncSession = Depends(get_async_session),
+):
+    cached = referral_cache.get_by_email(email)
+    if cached is MISSING:
+        result = await session.execute(referral_by_email(email))
+        result = result.fetchone()
+        cached = CachedReferral(*result) if result else None
+        referral_cache.set(cached, email=email)
+    if cached:
+        return {'referral': [cached.referral]}
+    return {'message': 'User has no referral'}
 
 
 @router.get('/get_my_referral/')
-async def get_referral(user: User = Depends(current_active_user)):
-    async with engine.begin() as conn:
-        result = await conn.execute(
-            select(Referral).
-            where(Referral.user_id == user.id),
-        )
+async def get_referral(
+    user: TokenUser = Depends(current_token_user),
+    session: AsyncSession = Depends(get_async_session),
+):
+    cached = referral_cache.get_by_user_id(user.id)
+    if cached is MISSING:
+        result = await session.execute(referral_by_user_id(user.id))
         result = result.fetchone()
-        if result:
-            return {'referral': result.referral, 'expires at': result.expires_at}  # noqa: E501
-        return {'message': 'You have no referrals'}
+        cached = CachedReferral(*result) if result else None
+        referral_cache.set(cached, user_id=user.id)
+    if cached:
+        return {'referral': cached.referral, 'expires at': cached.expires_at}  # noqa: E501
+    return {'message': 'You have no referrals'}
 
 
 @router.post('/new/')
 async def post_referral(
     referral: ReferralSchema,
     user: User = Depends(current_active_user),
+    session: AsyncSession = Depends(get_async_session),
 ):
-    async with async_session_maker.begin() as session:
-        existing_referral = await session.execute(
-            select(Referral).
-            where(Referral.user_id == user.id),
-        )
-        existing_referral = existing_referral.scalars().first()
-        if existing_referral:
-            raise HTTPException(400, 'You already have a referral')
-        new_referral = Referral(
-            referral=referral.referral,
-            user_id=user.id,
-            expires_at=referral.expires_at,
-        )
-        session.add(new_referral)
-        await session.commit()
-        return {'message': 'Referral added successfully!', 'object': new_referral}  # noqa: E501
+    existing_referral = await session.execute(
+        select(Referral).
+        where(Referral.user_id == user.id),
+    )
+    existing_referral = existing_referral.scalars().first()
+    if existing_referral:
+        raise HTTPException(400, 'You already have a referral')
+    new_referral = Referral(
+        referral=referral.referral,
+        user_id=user.id,
+        expires_at=referral.expires_at,
+    )
+    session.add(new_referral)
+    await session.commit()
+    await invalidation_bus.publish(
+        'referral',
+        code=new_referral.referral,
+        email=user.email,
+        user_id=user.id,
+    )
+    return {'message': 'Referral added successfully!', 'object': new_referral}  # noqa: E501
 
 
 @router.delete('/delete/')
-async def delete_referral(user: User = Depends(current_active_user)):
-    async with async_session_maker.begin() as session:
-        existing_referral = await session.execute(
-            select(Referral).
-            where(Referral.user_id == user.id),
-        )
-        existing_referral = existing_referral.scalars().first()
-        if not existing_referral:
-            raise HTTPException(400, 'You do not have a referral')
-        await session.delete(existing_referral)
-        await session.commit()
-        return {'message': 'Your referral was deleted successfully!'}
+async def delete_referral(
+    user: User = Depends(current_active_user),
+    session: AsyncSession = Depends(get_async_session),
+):
+    existing_referral = await session.execute(
+        select(Referral).
+        where(Referral.user_id == user.id),
+    )
+    existing_referral = existing_referral.scalars().first()
+    if not existing_referral:
+        raise HTTPException(400, 'You do not have a referral')
+    await session.delete(existing_referral)
+    await session.commit()
+    await invalidation_bus.publish(
+        'referral',
+        code=existing_referral.referral,
+        email=user.email,
+        user_id=user.id,
+    )
+    return {'message': 'Your referral was deleted successfully!'}
 
 
 @router.get('/get_referrals_by_referrer_id/{id}/')
-async def get_referrals_by_referrer_id(id: int):
-    async with async_session_maker.begin() as session:
-        result = await session.execute(
-            select(User.username).
-            join(Referral, User.referral_name == Referral.referral).
-            where(Referral.user_id == id),
+async def get_referrals_by_referrer_id(
+    id: int,
+    limit: int = Query(100, ge=1, le=1000),
+    after: Optional[int] = None,
+    stream: bool = False,
+    session: AsyncSession = Depends(get_read_session),
+):
+    # Keyset pagination on user.id: pass the returned "after" back
+    # to get the next page
+    query = referrals_by_referrer_id(id, after)
+
+    # NDJSON mode streams every referral after "after", ignoring the limit
+    if stream:
+        return StreamingResponse(
+            stream_ndjson(query, session_maker=read_session_maker),
+            media_type='application/x-ndjson',
         )
-        result = result.scalars().fetchall()
-        return {'referrer_id': id, 'referrals': result}
+
+    result = await session.execute(query.limit(limit))
+    result = result.fetchall()
+    return {
+        'referrer_id': id,
+        'referrals': [row.username for row in result],
+        'after': result[-1].id if len(result) == limit else None,
+    }
+
+
+@router.get('/stats/{id}/')
+async def get_referral_stats(
+    id: int,
+    session: AsyncSession = Depends(get_read_session),
+):
+    # Counters are materialized, the 24h / 7d windows have hourly resolution
+    since_24h, since_7d = windows()
+    result = await session.execute(
+        referral_stats_by_referrer_id(id, since_24h, since_7d),
+    )
+    result = result.mappings().fetchone()
+    if result is None:
+        return {
+            'referrer_id': id,
+            'total': 0,
+            'last_24h': 0,
+            'last_7d': 0,
+            'last_signup_at': None,
+        }
+    return result
+
+
+@router.get('/leaderboard/')
+async def get_leaderboard(
+    limit: int = Query(10, ge=1, le=100),
+    period: Literal['all', '7d', '24h'] = 'all',
+    session: AsyncSession = Depends(get_read_session),
+):
+    since_24h, since_7d = windows()
+    result = await session.execute(
+        referral_leaderboard(limit, since_24h, since_7d, period),
+    )
+    return {'period': period, 'referrers': result.mappings().fetchall()}
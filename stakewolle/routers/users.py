@@ -0,0 +1,36 @@
+import os
+
+from dotenv import load_dotenv
+from fastapi import APIRouter, Depends, HTTPException
+
+from stakewolle.backend import (
+    UserManager,
+    current_superuser,
+    get_user_manager,
+)
+from stakewolle.models.models import User
+from stakewolle.schemas.users import UserBulkCreate, UserBulkResponse
+
+
+load_dotenv()
+BULK_IMPORT_LIMIT = int(os.getenv('BULK_IMPORT_LIMIT', 50000))
+
+router = APIRouter(prefix='/users', tags=['users'])
+
+
+@router.post('/bulk/', response_model=UserBulkResponse)
+async def bulk_create(
+    payload: UserBulkCreate,
+    user: User = Depends(current_superuser),
+    user_manager: UserManager = Depends(get_user_manager),
+):
+    if len(payload.users) > BULK_IMPORT_LIMIT:
+        raise HTTPException(
+            413,
+            f'At most {BULK_IMPORT_LIMIT} users can be imported at once',
+        )
+    results = await user_manager.bulk_create(payload.users)
+    return {
+        'created': sum(result['status'] == 'created' for result in results),
+        'results': results,
+    }
@@ -1,8 +1,8 @@
-from typing import Optional
+from typing import Literal, Optional
 
 
 from fastapi_users import schemas
-from pydantic import EmailStr
+from pydantic import BaseModel, EmailStr
 
 
 class UserRead(schemas.BaseUser[int]):
@@ -31,3 +31,27 @@ class UserUpdate(schemas.BaseUserUpdate):
     is_active: Optional[bool] = True
     is_verified: Optional[bool] = False
     is_superuser: Optional[bool] = False
+
+
+class UserBulkCreate(BaseModel):
+    users: list[UserCreate]
+
+
+class UserBulkResult(BaseModel):
+    index: int
+    email: EmailStr
+    status: Literal[
+        'created',
+        'exists',
+        'duplicate',
+        'invalid_password',
+        'invalid_referral',
+        'expired_referral',
+    ]
+    id: Optional[int] = None
+    detail: Optional[str] = None
+
+
+class UserBulkResponse(BaseModel):
+    created: int
+    results: list[UserBulkResult]
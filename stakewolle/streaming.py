@@ -0,0 +1,71 @@
+import csv
+import io
+import json
+from typing import AsyncIterator
+
+from sqlalchemy import Select
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from stakewolle.engine import async_session_maker
+
+
+STREAM_BATCH_SIZE = 1000
+
+
+def _json_default(value):
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value)
+
+
+async def stream_ndjson(
+    query: Select,
+    batch_size: int = STREAM_BATCH_SIZE,
+    session_maker: async_sessionmaker = async_session_maker,
+) -> AsyncIterator[str]:
+    """
+    Stream the rows of a query as newline-delimited JSON objects.
+
+    Rows are read through a server-side cursor ``batch_size`` at a time and
+    each batch is flushed to the client before the next one is fetched, so
+    memory stays flat whatever the size of the result. The generator owns
+    its session since it outlives the request dependencies.
+
+    :param query: Column-projected select, keys of its rows become the keys
+    of the JSON objects.
+    :param batch_size: Rows fetched per round trip.
+    :param session_maker: Sessions of the engine to read from.
+    """
+    async with session_maker() as session:
+        result = await session.stream(
+            query.execution_options(yield_per=batch_size),
+        )
+        async for rows in result.partitions():
+            yield ''.join(
+                json.dumps(row._asdict(), default=_json_default) + '\n'
+                for row in rows
+            )
+
+
+async def stream_csv(
+    query: Select,
+    batch_size: int = STREAM_BATCH_SIZE,
+    session_maker: async_sessionmaker = async_session_maker,
+) -> AsyncIterator[str]:
+    """
+    Stream the rows of a query as CSV with a header line, the same way
+    as stream_ndjson.
+    """
+    async with session_maker() as session:
+        result = await session.stream(
+            query.execution_options(yield_per=batch_size),
+        )
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(result.keys())
+        async for rows in result.partitions():
+            writer.writerows(rows)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
@@ -1,16 +1,44 @@
 import asyncio
+import hashlib
+import heapq
+import json
+import logging
 import os
-from typing import Optional, Tuple, Union
+import random
+import re
+import tempfile
+import time
+from array import array
+from email.utils import parsedate_to_datetime
+from urllib.parse import parse_qsl, urlencode, urlsplit
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Iterator,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 
 import aiohttp
 from dataclasses import dataclass
 from dotenv import load_dotenv
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
 
-@dataclass
+
+@dataclass(slots=True)
 class TickerInfo:
     last: float  # Last price
     baseVolume: float  # Base currency volume_24h
@@ -18,30 +46,468 @@ class TickerInfo:
 
 
 Symbol = str  # Trading pair like ETH/USDT
+Emit = Callable[[Symbol, TickerInfo], Awaitable[None]]
+
+
+def fixture_name(url: str) -> str:
+    """
+        File name of the recorded response for url. Does not depend
+        on the host or on the order of query parameters, so fixtures
+        recorded against the exchange can be served from anywhere
+    """
+    parts = urlsplit(url)
+    path = re.sub('/+', '/', parts.path)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return hashlib.sha1(f'{path}?{query}'.encode()).hexdigest() + '.json'
+
+
+class TickerTable(Mapping[Symbol, TickerInfo]):
+    """
+        Columnar ticker snapshot: a symbol index plus one contiguous
+        float64 array per TickerInfo field.
+        Reads as a read-only dict of TickerInfo, rows are built on access.
+        Bulk operations are vectorized with numpy when it is installed
+    """
+
+    __slots__ = ('symbols', 'index', 'last', 'baseVolume', 'quoteVolume')
+
+    columns = ('last', 'baseVolume', 'quoteVolume')
+
+    def __init__(
+        self,
+        symbols: Sequence[Symbol] = (),
+        last: Sequence[float] = (),
+        baseVolume: Sequence[float] = (),
+        quoteVolume: Sequence[float] = (),
+    ):
+        self.symbols = list(symbols)
+        self.index = {symbol: i for i, symbol in enumerate(self.symbols)}
+        self.last = array('d', last)
+        self.baseVolume = array('d', baseVolume)
+        self.quoteVolume = array('d', quoteVolume)
+        if len(self.index) != len(self.symbols):
+            raise ValueError('Duplicate symbols in TickerTable')
+        for name in self.columns:
+            if len(getattr(self, name)) != len(self.symbols):
+                raise ValueError(f'Column {name} does not match symbols')
+
+    @classmethod
+    def from_tickers(
+        cls,
+        tickers: Mapping[Symbol, TickerInfo],
+    ) -> 'TickerTable':
+        table = cls()
+        for symbol, ticker in tickers.items():
+            table.put(symbol, ticker)
+        return table
+
+    def put(self, symbol: Symbol, ticker: TickerInfo):
+        """
+            Append a row, or overwrite the row of symbol if it exists.
+            Lets a snapshot be filled as tickers are streamed.
+            A new symbol raises BufferError while views from buffers()
+            or to_numpy() are alive, the columns cannot grow under them
+        """
+        i = self.index.get(symbol)
+        if i is None:
+            row = (ticker.last, ticker.baseVolume, ticker.quoteVolume)
+            grown = []
+            try:
+                for name, value in zip(self.columns, row):
+                    getattr(self, name).append(value)
+                    grown.append(name)
+            except BufferError:
+                for name in grown:
+                    getattr(self, name).pop()
+                raise BufferError(
+                    'TickerTable columns are exported by buffers() or '
+                    'to_numpy(), release the views before adding symbols',
+                ) from None
+            self.index[symbol] = len(self.symbols)
+            self.symbols.append(symbol)
+            return
+        self.last[i] = ticker.last
+        self.baseVolume[i] = ticker.baseVolume
+        self.quoteVolume[i] = ticker.quoteVolume
+
+    def __getitem__(self, symbol: Symbol) -> TickerInfo:
+        i = self.index[symbol]
+        return TickerInfo(
+            last=self.last[i],
+            baseVolume=self.baseVolume[i],
+            quoteVolume=self.quoteVolume[i],
+        )
+
+    def __iter__(self) -> Iterator[Symbol]:
+        return iter(self.symbols)
+
+    def __len__(self) -> int:
+        return len(self.symbols)
+
+    def __contains__(self, symbol) -> bool:
+        return symbol in self.index
+
+    def buffers(self) -> dict[str, memoryview]:
+        """
+            Zero-copy views of the columns, format 'd' (float64).
+            Suitable for Arrow buffers or any buffer protocol consumer.
+            The views pin the columns: until they are released, put() of
+            a new symbol raises BufferError
+        """
+        return {name: memoryview(getattr(self, name)) for name in self.columns}
+
+    def to_numpy(self) -> dict:
+        """
+            Zero-copy numpy views of the columns.
+            The views share memory with the table, do not write to them.
+            They pin the columns: until they are released, put() of
+            a new symbol raises BufferError
+        """
+        if np is None:
+            raise ImportError('numpy is required for TickerTable.to_numpy')
+        return {
+            name: np.frombuffer(getattr(self, name), dtype=np.float64)
+            for name in self.columns
+        }
+
+    def where(
+        self,
+        column: str = 'quoteVolume',
+        min: Optional[float] = None,
+        max: Optional[float] = None,
+    ) -> 'TickerTable':
+        """
+            Rows whose column value lies within [min, max]
+        """
+        if np is not None:
+            values = self.to_numpy()[column]
+            mask = np.ones(len(values), dtype=bool)
+            if min is not None:
+                mask &= values >= min
+            if max is not None:
+                mask &= values <= max
+            return self._take(np.flatnonzero(mask))
+
+        return self._take([
+            i for i, value in enumerate(getattr(self, column))
+            if (min is None or value >= min) and (max is None or value <= max)
+        ])
+
+    def top(self, n: int, by: str = 'quoteVolume') -> 'TickerTable':
+        """
+            n rows with the largest column value, in descending order
+        """
+        n = min(n, len(self))
+        if n <= 0:
+            return TickerTable()
+        if np is not None:
+            values = self.to_numpy()[by]
+            indices = np.argpartition(values, len(values) - n)[-n:]
+            return self._take(indices[np.argsort(-values[indices])])
+
+        values = getattr(self, by)
+        return self._take(
+            heapq.nlargest(n, range(len(values)), key=values.__getitem__),
+        )
+
+    def _take(self, indices) -> 'TickerTable':
+        if np is not None and isinstance(indices, np.ndarray):
+            arrays = self.to_numpy()
+            columns = [
+                arrays[name][indices].tobytes() for name in self.columns
+            ]
+        else:
+            columns = [
+                [getattr(self, name)[i] for i in indices]
+                for name in self.columns
+            ]
+        return TickerTable([self.symbols[i] for i in indices], *columns)
+
+
+class RateLimiter:
+    """
+        Token bucket: allows `rate` requests per second on average
+        and bursts of up to `capacity` requests.
+        pause() stops everyone for a while, ex. on 429 Too Many Requests
+    """
+
+    def __init__(self, rate: float, capacity: int = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._resume_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._resume_at:
+                    await asyncio.sleep(self._resume_at - now)
+                    continue
+                self._tokens = min(
+                    self.capacity,
+                    self._tokens + (now - self._updated) * self.rate,
+                )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        self._resume_at = max(self._resume_at, time.monotonic() + seconds)
+        self._tokens = 0.0
 
 
 class BaseExchange:
+    rate_limit: float = 10.0  # Requests per second
+    rate_limit_burst: int = 1
+    max_concurrency: int = 10  # Requests in flight at once
+    max_retries: int = 5
+    backoff_base: float = 1.0  # Seconds, doubled on every retry
+    connection_limit: int = 10  # Pooled connections of the session
+    keepalive_timeout: float = 30.0  # Seconds an idle connection is kept
+    dns_cache_ttl: int = 300  # Seconds
+    stream_queue_size: int = 1000  # Tickers buffered ahead of the consumer
+
+    def __init__(self):
+        self.id = type(self).__name__.lower()
+        self.headers = {}
+        self.cache_dir = os.path.join(
+            os.getenv('EXCHANGE_CACHE_DIR', '.cache'),
+            type(self).__name__.lower(),
+        )
+        # Every 200 response is saved here as a fixture, see task2_bench.py
+        self.record_dir = os.getenv('EXCHANGE_RECORD_DIR')
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.rate_limiter = RateLimiter(self.rate_limit, self.rate_limit_burst)
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def open(self):
+        """
+            Create the long-lived session all requests go through,
+            so that connections (TCP+TLS) and DNS lookups are reused
+        """
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.connection_limit,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=self.dns_cache_ttl,
+            )
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                headers=self.headers,
+            )
+
     async def fetch_data(self, url: str):
         """
+        Requests are paced by self.rate_limiter, so they can be
+        issued concurrently. 429 and 5xx responses are retried with
+        jittered exponential backoff, honoring Retry-After
         :param url: URL to fetch the data from exchange
         :return: raw data
         """
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as resp:
-                if resp and resp.status == 200:
-                    data = await resp.json()
-                else:
-                    raise Exception(resp)
+        _, _, data = await self._request(url)
         return data
 
+    async def _request(
+        self,
+        url: str,
+        headers: Optional[dict] = None,
+    ) -> Tuple[int, Mapping, Any]:
+        """
+            :param url: URL to fetch the data from exchange
+            :param headers: Extra request headers
+            :return: status (200 or 304), response headers (case-insensitive)
+            and raw data
+        """
+        await self.open()
+        for attempt in range(self.max_retries + 1):
+            async with self._semaphore:
+                await self.rate_limiter.acquire()
+                async with self.session.get(url, headers=headers) as resp:
+                    if resp and resp.status == 200:
+                        data = await resp.json()
+                        if self.record_dir:
+                            self._write_json(
+                                self.record_dir,
+                                fixture_name(url),
+                                {'url': url, 'data': data},
+                            )
+                        return resp.status, resp.headers, data
+                    if resp.status == 304:
+                        return resp.status, resp.headers, None
+                    retryable = resp.status == 429 or resp.status >= 500
+                    if not retryable or attempt == self.max_retries:
+                        raise Exception(resp)
+                    delay = self._retry_delay(
+                        attempt,
+                        resp.headers.get('Retry-After'),
+                    )
+                    if resp.status == 429:
+                        self.rate_limiter.pause(delay)
+            await asyncio.sleep(delay)
+
+    async def fetch_reference_data(self, url: str, name: str, ttl: float):
+        """
+            Fetch rarely changing data (coin lists and such) through
+            a cache on disk. Fresh entries are served without a request,
+            stale ones are revalidated with If-None-Match/If-Modified-Since,
+            and if the exchange can't be reached a stale entry is used
+            :param url: URL to fetch the data from exchange
+            :param name: Name of the cache entry
+            :param ttl: Seconds the entry is fresh for
+            :return: raw data
+        """
+        cached = self._read_cache(name)
+        if cached and time.time() - cached['fetched_at'] < ttl:
+            return cached['data']
+
+        headers = {}
+        if cached and cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached and cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+
+        try:
+            status, resp_headers, data = await self._request(url, headers)
+        except Exception as error:
+            if not cached:
+                raise
+            logger.warning(
+                '%s is unavailable (%r), using cached %s', url, error, name,
+            )
+            return cached['data']
+
+        if status == 304:
+            data = cached['data']
+        self._write_cache(name, {
+            'url': url,
+            'fetched_at': time.time(),
+            'etag': resp_headers.get('ETag'),
+            'last_modified': resp_headers.get('Last-Modified'),
+            'data': data,
+        })
+        return data
+
+    def _cache_path(self, name: str) -> str:
+        return os.path.join(self.cache_dir, f'{name}.json')
+
+    def _read_cache(self, name: str) -> Optional[dict]:
+        try:
+            with open(self._cache_path(name), encoding='utf-8') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def _write_cache(self, name: str, entry: dict):
+        self._write_json(self.cache_dir, f'{name}.json', entry)
+
+    def _write_json(self, directory: str, file_name: str, entry: dict):
+        # Write to a temporary file and rename it over the old one,
+        # so readers never see a half-written entry
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as file:
+                json.dump(entry, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, os.path.join(directory, file_name))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _retry_delay(self, attempt: int, retry_after: Optional[str]) -> float:
+        """
+            Full jitter backoff, but never earlier than the server asked for
+            :param attempt: Number of the failed attempt, from 0
+            :param retry_after: Retry-After header, seconds or HTTP date
+            :return: Seconds to wait before the next attempt
+        """
+        delay = random.uniform(0, self.backoff_base * 2 ** attempt)
+        if retry_after:
+            try:
+                delay = max(delay, float(retry_after))
+            except ValueError:
+                try:
+                    retry_at = parsedate_to_datetime(retry_after).timestamp()
+                    delay = max(delay, retry_at - time.time())
+                except (TypeError, ValueError):
+                    pass
+        return delay
+
     async def fetch_tickers(self) -> dict[Symbol, TickerInfo]:
         """
             Method fetch data from exchange and return all tickers
             in normalized format
             :return:
         """
+        return {symbol: ticker async for symbol, ticker in self.stream_tickers()}  # noqa: E501
+
+    async def stream_tickers(self) -> AsyncIterator[Tuple[Symbol, TickerInfo]]:  # noqa: E501
+        """
+            Yields normalized tickers as soon as their page is processed.
+            Up to self.stream_queue_size tickers are buffered, then
+            fetching waits for the consumer to catch up
+        """
+        queue = asyncio.Queue(self.stream_queue_size)
+        done = object()
+
+        async def emit(symbol: Symbol, ticker: TickerInfo):
+            await queue.put((symbol, ticker))
+
+        async def produce():
+            try:
+                await self._produce_tickers(emit)
+            except Exception as error:
+                await queue.put(error)
+            else:
+                await queue.put(done)
+
+        producer = asyncio.create_task(produce())
+        try:
+            while True:
+                item = await queue.get()
+                if item is done:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            producer.cancel()
+            try:
+                await producer
+            except asyncio.CancelledError:
+                pass
+
+    async def _produce_tickers(self, emit: Emit):
+        """
+            Fetch tickers and pass every one to emit as soon as it is
+            normalized. Awaiting emit applies the consumer's backpressure
+            :param emit: async callable taking (symbol, ticker)
+        """
         raise NotImplementedError
 
+    async def fetch_ticker_table(self) -> TickerTable:
+        """
+            fetch_tickers as a columnar TickerTable. Rows are appended
+            as tickers are streamed, the dict snapshot is never built
+        """
+        table = TickerTable()
+        async for symbol, ticker in self.stream_tickers():
+            table.put(symbol, ticker)
+        return table
+
     def normalize_data(self, data: dict) -> dict[Symbol, TickerInfo]:
         """
             :param data: raw data received from the exchange
@@ -72,9 +538,83 @@ class BaseExchange:
             (you can find the limits in the documentation for
             the exchange API)
         """
+        await self.open()
 
     async def close(self):
-        pass  # stub, not really needed
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+class BaseVolumeBatcher:
+    """
+        Collects the baseVolume lookups (id, vs_currency) of a whole
+        snapshot, across pages and vs_currencies, and resolves them
+        base_volume_batch_size ids per vs_currency at a time.
+        A lookup group is requested as soon as it is full, the rest
+        on flush(). Tickers waiting for a lookup are passed to
+        on_resolved(vs_currency, tickers) once their batch is fetched
+    """
+
+    def __init__(
+        self,
+        exchange: 'MyExchange',
+        on_resolved: Callable[[str, dict], Awaitable[None]],
+    ):
+        self.exchange = exchange
+        self.on_resolved = on_resolved
+        # (id, vs_currency) -> [(vs_currency of the page, symbol, info)]
+        self.waiting: dict[Tuple[str, str], list] = {}
+        # vs_currency of the lookup -> ids not requested yet
+        self.queued: dict[str, set] = {}
+        self.tasks: list[asyncio.Task] = []
+
+    def add(
+        self,
+        vs_currency: str,
+        symbol: Symbol,
+        info: dict,
+        request: Tuple[str, str],
+    ):
+        waiting = self.waiting.setdefault(request, [])
+        waiting.append((vs_currency, symbol, info))
+        if len(waiting) > 1:
+            return
+        coin_id, base_id = request
+        ids = self.queued.setdefault(base_id, set())
+        ids.add(coin_id)
+        if len(ids) >= self.exchange.base_volume_batch_size:
+            self._request(base_id)
+
+    async def flush(self):
+        """
+            Request the remaining lookups and wait for every batch
+        """
+        for base_id in list(self.queued):
+            self._request(base_id)
+        await asyncio.gather(*self.tasks)
+
+    def cancel(self):
+        for task in self.tasks:
+            task.cancel()
+
+    def _request(self, base_id: str):
+        requests = {(coin_id, base_id) for coin_id in self.queued.pop(base_id)}
+        self.tasks.append(asyncio.create_task(self._resolve(requests)))
+
+    async def _resolve(self, requests: set[Tuple[str, str]]):
+        base_volumes = await self.exchange._get_base_volumes(requests)
+        resolved = {}
+        for request in requests:
+            for vs_currency, symbol, info in self.waiting.pop(request):
+                if request in base_volumes:
+                    info['baseVolume'] = base_volumes[request]
+                resolved.setdefault(vs_currency, {})[symbol] = info
+        for vs_currency, data in resolved.items():
+            await self.on_resolved(
+                vs_currency,
+                self.exchange.normalize_data(data),
+            )
 
 
 class MyExchange(BaseExchange):
@@ -82,42 +622,37 @@ class MyExchange(BaseExchange):
         docs: https://docs.coingecko.com/v3.0.1/reference/introduction
     """
 
+    # Лимит Demo API - 30 запросов в минуту
+    rate_limit = float(os.getenv('API_RATE_LIMIT', 30)) / 60
+    # Сколько id запрашивать за раз при пересчете baseVolume
+    base_volume_batch_size = 250
+    # Сколько секунд списки валют в кэше считаются свежими
+    reference_data_ttl = float(os.getenv('REFERENCE_DATA_TTL', 86400))
+    # Размер страницы /coins/markets (максимум API) и сколько
+    # страниц одной vs_currency запрашивать одновременно
+    per_page = 250
+    page_fan_out = 4
+    # Через сколько секунд refresh_tickers перезапрашивает vs_currency
+    ticker_max_age = float(os.getenv('TICKER_MAX_AGE', 300))
+
     def __init__(self):
+        super().__init__()
         self.id = 'coingecko'
         self.base_url = 'https://api.coingecko.com/api/v3/'
         self.markets = {}
-
-    # Перепишем функцию, добавив паузу и хэдер API-ключа
-    async def fetch_data(self, url: str):
-        """
-        :param url: URL to fetch the data from exchange
-        :return: raw data
-        """
-        headers = {'x-cg-demo-api-key': os.getenv('API_KEY', '')}
-        async with aiohttp.ClientSession(headers=headers) as session:
-            async with session.get(url) as resp:
-                if resp and resp.status == 200:
-                    data = await resp.json()
-                else:
-                    raise Exception(resp)
-        await asyncio.sleep(2)
-        return data
+        self.headers = {'x-cg-demo-api-key': os.getenv('API_KEY', '')}
+        self.vs_currencies = []
+        self.vs_currencies_set = set()
+        self.base_volume_ids = {}
+        # Последний снимок тикеров, он же по каждой vs_currency
+        # и время, когда vs_currency запрашивалась
+        self.tickers = {}
+        self.pages = {}
+        self.pages_fetched_at = {}
 
     def _convert_symbol_to_ccxt(self, symbols: str) -> Symbol:
         pass
 
-    def _find_identical_coins(
-        self,
-        base_currencies_list: list,
-        currency: str,
-    ) -> list:
-
-        identical_symbols_coins = filter(
-            lambda x: x['symbol'] == currency,
-            base_currencies_list,
-        )
-        return list(identical_symbols_coins)
-
     def _convert_trading_pair_name(self, base: str, target: str) -> str:
         return f"{base.upper()}/{target.upper()}"
 
@@ -150,51 +685,75 @@ class MyExchange(BaseExchange):
 
         return None, None
 
+    def _build_coin_index(self, base_currencies_list: list) -> dict:
+
+        # Для каждого символа находим истинную валюту.
+        # В исходном списке присутствует много лишней информации.
+        # По наблюдениям истинной валютой
+        # является валюта с самым коротким id
+        coin_index = {}
+        for coin in base_currencies_list:
+            true_id = coin_index.get(coin['symbol'])
+            if true_id is None or coin['id'] < true_id:
+                coin_index[coin['symbol']] = coin['id']
+        return coin_index
+
     def _check_base_value_for_volume(
         self,
         base_currency: str,
         vs_currency: str,
-        base_currencies_list: list,
-        vs_currencies_list: list,
     ) -> Optional[str]:
 
         # Проверяем наличие vs_currency в списке базовых валют и
-        # находим истинную.
-        # В исходном списке присутствует много лишней информации.
-        # По наблюдениям истинной валютой
-        # является валюта с самым коротким id
-        identical_symbols_coins = self._find_identical_coins(
-            base_currencies_list,
-            vs_currency,
-        )
-
-        if (identical_symbols_coins != []) and (base_currency in vs_currencies_list):  # noqa: E501
-            identical_symbols_ids = [
-                el['id'] for el in identical_symbols_coins
-            ]
-            true_id = min(identical_symbols_ids)
-            return true_id
+        # есть ли базовая валюта в списке vs_currencies.
+        # Обе проверки - поиск по заранее построенным индексам
+        if base_currency in self.vs_currencies_set:
+            return self.base_volume_ids.get(vs_currency)
 
         return None
 
-    async def _get_base_volume(
+    async def _get_base_volumes(
         self,
-        vs_currency_based_id: str,
-        base_id: str,
-    ) -> int:
+        requests: set[Tuple[str, str]],
+    ) -> dict[Tuple[str, str], float]:
 
-        # Создаем обратный запрос, чтобы пересчитать baseVolume
-        # в рамках trading pair
-        subresponse = await self.fetch_data(
-            f"{self.base_url}/coins/markets/?ids={vs_currency_based_id}&vs_currency={base_id}")  # noqa: E501
+        # Создаем обратные запросы, чтобы пересчитать baseVolume
+        # в рамках trading pair. ids принимает список через запятую,
+        # поэтому группируем id по vs_currency и запрашиваем пачками
+        ids_by_vs_currency = {}
+        for vs_currency_based_id, base_id in requests:
+            ids_by_vs_currency.setdefault(base_id, set()).add(
+                vs_currency_based_id,
+            )
+
+        batches = []
+        for base_id, ids in ids_by_vs_currency.items():
+            ids = sorted(ids)
+            for start in range(0, len(ids), self.base_volume_batch_size):
+                batches.append((
+                    base_id,
+                    ids[start:start + self.base_volume_batch_size],
+                ))
 
-        return subresponse[0]['total_volume']
+        subresponses = await asyncio.gather(*[
+            self.fetch_data(f"{self.base_url}/coins/markets/?ids={','.join(ids)}&vs_currency={base_id}&per_page={len(ids)}")  # noqa: E501
+            for base_id, ids in batches
+        ])
+
+        base_volumes = {}
+        for (base_id, _), subresponse in zip(batches, subresponses):
+            for coin in subresponse:
+                base_volumes[(coin['id'], base_id)] = coin['total_volume']
+        return base_volumes
 
     def normalize_data(self, data: dict) -> dict[Symbol, TickerInfo]:
 
         normalized_data = {}
 
-        for key, val in data.items():
+        # Промежуточные словари освобождаем по ходу,
+        # чтобы две копии снимка не жили одновременно
+        for key in list(data):
+            val = data.pop(key)
             normalized_data[key] = TickerInfo(
                 last=val['last'],
                 baseVolume=val['baseVolume'],
@@ -203,9 +762,9 @@ class MyExchange(BaseExchange):
 
         return normalized_data
 
-    async def fetch_tickers(self) -> dict[Symbol, TickerInfo]:
+    async def _produce_tickers(self, emit: Emit):
 
-        # Получаем базовый список валют и vs_currencies.
+        # Базовый список валют и vs_currencies загружает load_markets.
         # Изначально смутила формулировка total_volume. 
         # Планировал уже пересчитывать через объемы продаж по часам,
         # так как если задать на эндпоинте посуточную информацию, 
@@ -214,60 +773,361 @@ class MyExchange(BaseExchange):
         # лютных величинах, а скользящие значения посуточных величин от
         # конкретного часа. Так что остановился на варианте ниже,
         # тем более что по сверке с сайтом информация около-актуальная.
-        base_currencies = await self.fetch_data(f"{self.base_url}/coins/list")
-        vs_currencies = await self.fetch_data(f"{self.base_url}/simple/supported_vs_currencies")  # noqa: E501
+        if not self.vs_currencies:
+            await self.load_markets()
 
-        data = {}
+        self._update_pages(
+            await self._fetch_pages(self.vs_currencies, emit),
+        )
+
+    async def fetch_ticker_table(self) -> TickerTable:
+
+        # Таблицу заполняем прямо из нормализованных страниц,
+        # минуя снимок self.tickers для refresh_tickers
+        if not self.vs_currencies:
+            await self.load_markets()
+
+        table = TickerTable()
+
+        async def put(symbol: Symbol, ticker: TickerInfo):
+            table.put(symbol, ticker)
+
+        await self._fetch_pages(self.vs_currencies, put, keep=False)
+        return table
+
+    async def refresh_tickers(
+        self,
+        max_age: Optional[float] = None,
+    ) -> Tuple[dict[Symbol, TickerInfo], set[Symbol]]:
+        """
+            Incremental fetch_tickers: keeps the previous snapshot and
+            refetches only vs_currencies fetched more than max_age
+            seconds ago
+            :param max_age: Freshness bound, self.ticker_max_age by default
+            :return: merged snapshot and symbols changed since the last call
+        """
+        if not self.vs_currencies:
+            await self.load_markets()
+        if max_age is None:
+            max_age = self.ticker_max_age
 
-        for vs_currency in vs_currencies:
+        now = time.monotonic()
+        stale = [
+            vs_currency for vs_currency in self.vs_currencies
+            if vs_currency not in self.pages_fetched_at
+            or now - self.pages_fetched_at[vs_currency] >= max_age
+        ]
+        changed = self._update_pages(await self._fetch_pages(stale))
+        return dict(self.tickers), changed
 
-            # По каждой vs_currency просматриваем курсы
-            # относительно базовых валют
-            response = await self.fetch_data(f"{self.base_url}/coins/markets/?vs_currency={vs_currency}&category=cryptocurrency")  # noqa: E501
+    def _update_pages(
+        self,
+        pages: dict[str, dict[Symbol, TickerInfo]],
+    ) -> set[Symbol]:
+        """
+            Replace the tickers of the given vs_currencies in the snapshot
+            :param pages: vs_currency -> its tickers
+            :return: added, removed and changed symbols
+        """
+        changed = set()
+        for vs_currency, tickers in pages.items():
+            previous = self.pages.get(vs_currency, {})
+            for symbol in previous.keys() - tickers.keys():
+                del self.tickers[symbol]
+                changed.add(symbol)
+            for symbol, ticker in tickers.items():
+                if previous.get(symbol) != ticker:
+                    changed.add(symbol)
+            self.tickers.update(tickers)
+            self.pages[vs_currency] = tickers
+            self.pages_fetched_at[vs_currency] = time.monotonic()
+        return changed
 
-            for trading_pair in response:
+    async def _fetch_pages(
+        self,
+        vs_currencies: list,
+        emit: Optional[Emit] = None,
+        keep: bool = True,
+    ) -> dict[str, dict[Symbol, TickerInfo]]:
+        """
+            :param emit: called with every ticker as soon as it is ready
+            :param keep: collect the tickers into the returned pages,
+            without it only emit gets them
+            :return: vs_currency -> its tickers
+        """
+
+        pages = {vs_currency: {} for vs_currency in vs_currencies}
+
+        async def store(vs_currency: str, tickers: dict[Symbol, TickerInfo]):
+            if keep:
+                pages[vs_currency].update(tickers)
+            if emit is not None:
+                for symbol, ticker in tickers.items():
+                    await emit(symbol, ticker)
 
-                # Обрабатываем основной запрос: проверяем,
-                # чтобы базовая и котируемая валюты
-                # не дублировались, конвертируем имя,
-                # создаем словарь с информацией
-                key, val = self._process_trading_pair_vs_currency(
-                    trading_pair,
+        # Пересчет baseVolume копим по всему снимку, а не по странице:
+        # в одной странице у всех пересчетов один и тот же id,
+        # так что пачки по vs_currency получались бы из одного id
+        batcher = BaseVolumeBatcher(self, store)
+
+        # По каждой vs_currency просматриваем курсы
+        # относительно базовых валют. Страницы нормализуются
+        # и отдаются в emit по мере получения, пары с пересчетом
+        # baseVolume - когда придет их пачка
+        async def collect(vs_currency: str):
+            async for response in self._iter_market_pages(vs_currency):
+                await store(
                     vs_currency,
+                    self._process_page(vs_currency, response, batcher),
                 )
 
-                # Если ключа нет (валюты дублируются) - пропускаем остальное
-                if key is None:
-                    continue
+        # Запросы по всем vs_currency и их страницам отправляем
+        # одновременно, темп задает rate limiter
+        try:
+            await asyncio.gather(*[
+                collect(vs_currency) for vs_currency in vs_currencies
+            ])
+            await batcher.flush()
+        finally:
+            batcher.cancel()
+
+        return pages
 
-                # Проверяем, есть ли vs_currency в общем списке,
-                # и есть ли базовая валюта в списке vs_currencies
-                # для возможности расчет baseVolume через обратный запрос.
-                # Вернется либо нужный id, либо None
-                id_for_base_volume = self._check_base_value_for_volume(
+    def _process_page(
+        self,
+        vs_currency: str,
+        response: list,
+        batcher: BaseVolumeBatcher,
+    ) -> dict[Symbol, TickerInfo]:
+        """
+            :return: tickers of the page that need no baseVolume lookup,
+            the others are passed to batcher
+        """
+
+        data = {}
+        base_volume_requests = {}
+
+        for trading_pair in response:
+
+            # Обрабатываем основной запрос: проверяем,
+            # чтобы базовая и котируемая валюты
+            # не дублировались, конвертируем имя,
+            # создаем словарь с информацией
+            key, val = self._process_trading_pair_vs_currency(
+                trading_pair,
+                vs_currency,
+            )
+
+            # Если ключа нет (валюты дублируются) - пропускаем остальное
+            if key is None:
+                continue
+
+            # Проверяем, есть ли vs_currency в общем списке,
+            # и есть ли базовая валюта в списке vs_currencies
+            # для возможности расчет baseVolume через обратный запрос.
+            # Вернется либо нужный id, либо None
+            id_for_base_volume = self._check_base_value_for_volume(
+                trading_pair['symbol'],
+                vs_currency,
+            )
+
+            # baseVolume запросим после, пачкой по всему снимку
+            if id_for_base_volume:
+                base_volume_requests[key] = (
+                    id_for_base_volume,
                     trading_pair['symbol'],
-                    vs_currency,
-                    base_currencies,
-                    vs_currencies,
                 )
+            else:
+                base_volume_requests.pop(key, None)
 
-                # Переписываем baseVolume
-                if id_for_base_volume:
-                    val['baseVolume'] = await self._get_base_volume(
-                        id_for_base_volume,
-                        trading_pair['symbol'],
-                    )
+            # Создаем пару ключ-значение в словаре
+            data[key] = val
+            logger.debug('data: %s, value: %s', key, val)
 
-                # Создаем пару ключ-значение в словаре и
-                # тут же просматриваем в консоли
-                data[key] = val
-                print(f'data: {key}')
-                print(f'value: {val}')
+        # Пары с пересчетом baseVolume ждут своей пачки
+        for key, request in base_volume_requests.items():
+            batcher.add(vs_currency, key, data.pop(key), request)
 
         return self.normalize_data(data)
 
+    async def _iter_market_pages(self, vs_currency: str):
+        """
+            Yields pages of /coins/markets for vs_currency as they arrive.
+            Up to self.page_fan_out pages are requested at once, no new
+            pages are requested after the first short one
+        """
+        tasks = {}
+        next_page = 1
+        last_page = None
+        try:
+            while True:
+                while last_page is None and len(tasks) < self.page_fan_out:
+                    task = asyncio.create_task(self.fetch_data(
+                        f"{self.base_url}/coins/markets/?vs_currency={vs_currency}&category=cryptocurrency&per_page={self.per_page}&page={next_page}",  # noqa: E501
+                    ))
+                    tasks[task] = next_page
+                    next_page += 1
+                if not tasks:
+                    return
+
+                done, _ = await asyncio.wait(
+                    tasks,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                for task in done:
+                    page = tasks.pop(task)
+                    response = task.result()
+                    if len(response) < self.per_page:
+                        last_page = min(last_page or page, page)
+                    yield response
+
+                # Страницы после неполной заведомо пустые
+                for task, page in list(tasks.items()):
+                    if last_page is not None and page > last_page:
+                        task.cancel()
+                        del tasks[task]
+        finally:
+            for task in tasks:
+                task.cancel()
+
     async def load_markets(self):
-        pass
+        await super().load_markets()
+
+        # Получаем базовый список валют и vs_currencies
+        # и один раз строим по ним индексы для fetch_tickers
+        # Списки меняются редко, поэтому берем их из кэша на диске
+        base_currencies = await self.fetch_reference_data(
+            f"{self.base_url}/coins/list",
+            'coins_list',
+            self.reference_data_ttl,
+        )
+        vs_currencies = await self.fetch_reference_data(
+            f"{self.base_url}/simple/supported_vs_currencies",
+            'supported_vs_currencies',
+            self.reference_data_ttl,
+        )
+        self._index_markets(base_currencies, vs_currencies)
+
+    def _index_markets(self, base_currencies: list, vs_currencies: list):
+        coin_index = self._build_coin_index(base_currencies)
+        self.vs_currencies = vs_currencies
+        self.vs_currencies_set = set(vs_currencies)
+        # vs_currency -> id монеты для пересчета baseVolume
+        self.base_volume_ids = {
+            vs_currency: coin_index[vs_currency]
+            for vs_currency in vs_currencies
+            if vs_currency in coin_index
+        }
+
+
+@dataclass(slots=True)
+class AggregatedTicker:
+    low: float  # Lowest last price among exchanges
+    lowExchange: str
+    high: float  # Highest last price among exchanges
+    highExchange: str
+    baseVolume: float  # Summed over exchanges
+    quoteVolume: float  # Summed over exchanges
+    exchanges: Tuple[str, ...]
+
+
+class ExchangeAggregator:
+    """
+        Runs several exchanges concurrently and merges their tickers
+        into one cross-exchange view.
+        Every exchange keeps its own session and rate limiter and gets
+        self.timeout seconds. A failing or slow exchange is logged,
+        recorded in self.errors and left out of the merge
+    """
+
+    def __init__(
+        self,
+        exchanges: Sequence[BaseExchange],
+        timeout: float = 60.0,
+    ):
+        ids = [exchange.id for exchange in exchanges]
+        if len(set(ids)) != len(ids):
+            raise ValueError(f'Exchange ids must be unique: {ids}')
+        self.exchanges = list(exchanges)
+        self.timeout = timeout
+        self.errors: dict[str, Exception] = {}
+
+    async def __aenter__(self):
+        await asyncio.gather(*[
+            exchange.open() for exchange in self.exchanges
+        ])
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        await asyncio.gather(
+            *[exchange.close() for exchange in self.exchanges],
+            return_exceptions=True,
+        )
+
+    async def fetch_all(self) -> dict[str, dict[Symbol, TickerInfo]]:
+        """
+            :return: exchange id -> its tickers, for exchanges that
+            answered in time
+        """
+        self.errors = {}
+        results = await asyncio.gather(*[
+            self._fetch(exchange) for exchange in self.exchanges
+        ])
+        return {
+            exchange.id: tickers
+            for exchange, tickers in zip(self.exchanges, results)
+            if tickers is not None
+        }
+
+    async def fetch_tickers(self) -> dict[Symbol, AggregatedTicker]:
+        return self.merge(await self.fetch_all())
+
+    async def _fetch(
+        self,
+        exchange: BaseExchange,
+    ) -> Optional[dict[Symbol, TickerInfo]]:
+        try:
+            return await asyncio.wait_for(
+                exchange.fetch_tickers(),
+                self.timeout,
+            )
+        except Exception as error:
+            logger.warning('%s failed: %r', exchange.id, error)
+            self.errors[exchange.id] = error
+            return None
+
+    @staticmethod
+    def merge(
+        tickers_by_exchange: Mapping[str, Mapping[Symbol, TickerInfo]],
+    ) -> dict[Symbol, AggregatedTicker]:
+        merged = {}
+        for exchange_id, tickers in tickers_by_exchange.items():
+            for symbol, ticker in tickers.items():
+                aggregated = merged.get(symbol)
+                if aggregated is None:
+                    merged[symbol] = AggregatedTicker(
+                        low=ticker.last,
+                        lowExchange=exchange_id,
+                        high=ticker.last,
+                        highExchange=exchange_id,
+                        baseVolume=ticker.baseVolume,
+                        quoteVolume=ticker.quoteVolume,
+                        exchanges=(exchange_id,),
+                    )
+                    continue
+                if ticker.last < aggregated.low:
+                    aggregated.low = ticker.last
+                    aggregated.lowExchange = exchange_id
+                if ticker.last > aggregated.high:
+                    aggregated.high = ticker.last
+                    aggregated.highExchange = exchange_id
+                aggregated.baseVolume += ticker.baseVolume
+                aggregated.quoteVolume += ticker.quoteVolume
+                aggregated.exchanges += (exchange_id,)
+        return merged
 
 
 async def main():
@@ -275,9 +1135,9 @@ async def main():
         Test yourself here.
         Verify prices and volumes here: https://www.coingecko.com/
     """
-    exchange = MyExchange()
-    await exchange.load_markets()
-    tickers = await exchange.fetch_tickers()
+    async with MyExchange() as exchange:
+        await exchange.load_markets()
+        tickers = await exchange.fetch_tickers()
     for symbol, prop in tickers.items():
         print(symbol, prop)
 
@@ -287,4 +1147,5 @@ async def main():
         assert isinstance(symbol, Symbol)
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     asyncio.run(main())
@@ -0,0 +1,428 @@
+"""
+Offline benchmark of the task 2 exchange client.
+
+Serves recorded responses from a local fake CoinGecko (ReplayServer) with
+configurable latency and 429 injection, runs MyExchange against it and
+reports requests/sec, snapshot wall-clock time, peak memory and
+normalization time per trading pair.
+
+Record fixtures against the live API (needs API_KEY):
+    EXCHANGE_RECORD_DIR=.cache/fixtures python task2.py
+or generate synthetic ones, recorded the same way from a generated market:
+    python task2_bench.py --generate 5000
+
+With --index, times the symbol -> coin index of load_markets and the
+per-pair baseVolume id lookups on the recorded /coins/list instead, next
+to the linear scan over the coin list it replaced.
+
+Usage: python task2_bench.py [--latency 0.05] [--error-rate 0.05]
+    [--index] [--output result.json] [--baseline previous.json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from urllib.parse import parse_qsl, urlsplit
+
+from aiohttp import web
+
+from task2 import MyExchange, RateLimiter, fixture_name
+
+
+DEFAULT_FIXTURES = os.path.join('.cache', 'fixtures')
+# Metrics compared with --baseline, all of them are "lower is better"
+COMPARED = (
+    'snapshot_seconds',
+    'peak_memory_mb',
+    'normalize_us_per_pair',
+    'index_ms',
+    'lookup_us_per_pair',
+)
+
+
+class ReplayServer:
+    """
+    Serves fixtures saved with EXCHANGE_RECORD_DIR. Every request waits
+    `latency` seconds and is answered with 429 with `error_rate`
+    probability. Pages past the recorded ones are answered with an empty
+    list, like CoinGecko does, anything else unknown with 404.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        latency: float = 0.0,
+        error_rate: float = 0.0,
+        seed: int = 0,
+    ):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+        self.throttled = 0
+        self.fixtures = {}
+        self._random = random.Random(seed)
+        self._runner = None
+        for name in os.listdir(directory):
+            if name.endswith('.json'):
+                with open(os.path.join(directory, name)) as file:
+                    self.fixtures[name] = json.load(file)
+        # Served bodies are serialized once, outside of the measurements
+        self._bodies = {
+            name: json.dumps(fixture['data'])
+            for name, fixture in self.fixtures.items()
+        }
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        """
+        :return: URL to use as the exchange base_url
+        """
+        app = web.Application()
+        app.router.add_get('/{tail:.*}', self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        host, port = self._runner.addresses[0][:2]
+        return f'http://{host}:{port}/api/v3/'
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def market_pages(self) -> list:
+        """
+        :return: (vs_currency, rows) of every recorded /coins/markets page
+        """
+        pages = []
+        for fixture in self.fixtures.values():
+            url = urlsplit(fixture['url'])
+            query = dict(parse_qsl(url.query))
+            if url.path.rstrip('/').endswith('coins/markets') and 'page' in query:  # noqa: E501
+                pages.append((query['vs_currency'], fixture['data']))
+        return pages
+
+    def reference_data(self, path: str):
+        """
+        :param path: End of the URL path, like coins/list
+        :return: Data of the recorded response, None if there is none
+        """
+        for fixture in self.fixtures.values():
+            if urlsplit(fixture['url']).path.rstrip('/').endswith(path):
+                return fixture['data']
+        return None
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self._random.random() < self.error_rate:
+            self.throttled += 1
+            return web.Response(status=429)
+        body = self._bodies.get(fixture_name(str(request.url)))
+        if body is not None:
+            return web.Response(text=body, content_type='application/json')
+        if 'page' in request.query:
+            return web.json_response([])
+        return web.Response(status=404)
+
+
+class SyntheticMarket:
+    """
+    Generated CoinGecko with `coins` coins, used to record fixtures on
+    machines that can't reach the real one.
+    """
+
+    vs_currencies = ['usd', 'eur', 'btc', 'eth']
+
+    def __init__(self, coins: int, seed: int = 0):
+        rng = random.Random(seed)
+        self.coins = [
+            {'id': 'bitcoin', 'symbol': 'btc', 'name': 'Bitcoin'},
+            {'id': 'ethereum', 'symbol': 'eth', 'name': 'Ethereum'},
+        ] + [
+            {'id': f'coin-{i}', 'symbol': f'c{i}', 'name': f'Coin {i}'}
+            for i in range(coins - 2)
+        ]
+        self.markets = {
+            coin['id']: {
+                'current_price': rng.lognormvariate(0, 3),
+                'total_volume': rng.randint(0, 10 ** 9),
+            }
+            for coin in self.coins
+        }
+        self._runner = None
+
+    async def start(self) -> str:
+        app = web.Application()
+        app.router.add_get('/{tail:.*}', self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        host, port = self._runner.addresses[0][:2]
+        return f'http://{host}:{port}/api/v3/'
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        path = request.path.rstrip('/')
+        if path.endswith('coins/list'):
+            return web.json_response(self.coins)
+        if path.endswith('supported_vs_currencies'):
+            return web.json_response(self.vs_currencies)
+        if not path.endswith('coins/markets'):
+            return web.Response(status=404)
+
+        coins = self.coins
+        if 'ids' in request.query:
+            ids = set(request.query['ids'].split(','))
+            coins = [coin for coin in coins if coin['id'] in ids]
+        per_page = int(request.query.get('per_page', 100))
+        page = int(request.query.get('page', 1))
+        return web.json_response([
+            {
+                'id': coin['id'],
+                'symbol': coin['symbol'],
+                'name': coin['name'],
+                **self.markets[coin['id']],
+            }
+            for coin in coins[(page - 1) * per_page:page * per_page]
+        ])
+
+
+def _exchange(base_url: str, cache_dir: str, args) -> MyExchange:
+    exchange = MyExchange()
+    exchange.base_url = base_url
+    exchange.cache_dir = cache_dir
+    exchange.backoff_base = args.backoff
+    exchange.rate_limiter = RateLimiter(args.rate, args.burst)
+    return exchange
+
+
+async def generate(args):
+    market = SyntheticMarket(args.generate, args.seed)
+    base_url = await market.start()
+    with tempfile.TemporaryDirectory() as cache_dir:
+        exchange = _exchange(base_url, cache_dir, args)
+        exchange.record_dir = args.fixtures
+        async with exchange:
+            tickers = await exchange.fetch_tickers()
+    await market.stop()
+    print(f'Recorded {len(tickers)} tickers to {args.fixtures}')
+
+
+def normalize_us_per_pair(exchange: MyExchange, pages: list) -> float:
+    """
+    CPU time of turning raw pages into TickerInfo, without the network
+    """
+    pairs = sum(len(rows) for _, rows in pages)
+    best = float('inf')
+    for _ in range(5):
+        start = time.perf_counter()
+        for vs_currency, rows in pages:
+            data = {}
+            for trading_pair in rows:
+                key, val = exchange._process_trading_pair_vs_currency(
+                    trading_pair,
+                    vs_currency,
+                )
+                if key is not None:
+                    data[key] = val
+            exchange.normalize_data(data)
+        best = min(best, time.perf_counter() - start)
+    return best / max(pairs, 1) * 1e6
+
+
+def linear_base_volume_id(
+    coins: list,
+    vs_currencies: list,
+    base_currency: str,
+    vs_currency: str,
+):
+    """
+    The lookup load_markets indexes, as it was done per pair before:
+    a scan of the whole coin list and a list membership test
+    """
+    ids = [coin['id'] for coin in coins if coin['symbol'] == vs_currency]
+    if ids and base_currency in vs_currencies:
+        return min(ids)
+    return None
+
+
+def index_benchmark(args) -> dict:
+    server = ReplayServer(args.fixtures)
+    coins = server.reference_data('coins/list')
+    vs_currencies = server.reference_data('simple/supported_vs_currencies')
+    if coins is None or vs_currencies is None:
+        raise SystemExit(
+            f'No /coins/list or /simple/supported_vs_currencies fixture '
+            f'in {args.fixtures}',
+        )
+    pairs = [
+        (row['symbol'], vs_currency)
+        for vs_currency, rows in server.market_pages()
+        for row in rows
+    ]
+    if not pairs:
+        raise SystemExit(f'No /coins/markets fixtures in {args.fixtures}')
+
+    exchange = MyExchange()
+    best_index = best_lookup = float('inf')
+    for _ in range(5):
+        start = time.perf_counter()
+        exchange._index_markets(coins, vs_currencies)
+        best_index = min(best_index, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for base_currency, vs_currency in pairs:
+            exchange._check_base_value_for_volume(base_currency, vs_currency)
+        best_lookup = min(best_lookup, time.perf_counter() - start)
+
+    # The scan is O(coins) per pair, a sample is enough
+    sample = random.Random(args.seed).sample(
+        pairs,
+        min(args.index_sample, len(pairs)),
+    )
+    start = time.perf_counter()
+    linear = [
+        linear_base_volume_id(coins, vs_currencies, *pair) for pair in sample
+    ]
+    linear_seconds = time.perf_counter() - start
+    mismatches = sum(
+        exchange._check_base_value_for_volume(*pair) != expected
+        for pair, expected in zip(sample, linear)
+    )
+
+    return {
+        'coins': len(coins),
+        'pairs': len(pairs),
+        'index_ms': best_index * 1000,
+        'lookup_us_per_pair': best_lookup / len(pairs) * 1e6,
+        'linear_us_per_pair': linear_seconds / len(sample) * 1e6,
+        'mismatches': mismatches,
+    }
+
+
+async def benchmark(args) -> dict:
+    server = ReplayServer(
+        args.fixtures,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        seed=args.seed,
+    )
+    if not server.fixtures:
+        raise SystemExit(f'No fixtures in {args.fixtures}')
+    base_url = await server.start()
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        exchange = _exchange(base_url, cache_dir, args)
+        async with exchange:
+            await exchange.load_markets()
+
+            walls, rates = [], []
+            for _ in range(args.rounds):
+                requests = server.requests
+                start = time.perf_counter()
+                tickers = await exchange.fetch_tickers()
+                wall = time.perf_counter() - start
+                walls.append(wall)
+                rates.append((server.requests - requests) / wall)
+
+            tracemalloc.start()
+            await exchange.fetch_tickers()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            normalize = normalize_us_per_pair(exchange, server.market_pages())
+    await server.stop()
+
+    return {
+        'tickers': len(tickers),
+        'rounds': args.rounds,
+        'requests_per_second': statistics.median(rates),
+        'snapshot_seconds': statistics.median(walls),
+        'peak_memory_mb': peak / 2 ** 20,
+        'normalize_us_per_pair': normalize,
+        'throttled': server.throttled,
+    }
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> list:
+    """
+    :return: Descriptions of the metrics that got worse than tolerance
+    """
+    regressions = []
+    for metric in COMPARED:
+        if metric not in baseline or metric not in result:
+            continue
+        if result[metric] > baseline[metric] * (1 + tolerance):
+            regressions.append(
+                f'{metric}: {baseline[metric]:.3f} -> {result[metric]:.3f}',
+            )
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--fixtures', default=DEFAULT_FIXTURES)
+    parser.add_argument('--generate', type=int, metavar='COINS',
+                        help='record synthetic fixtures and exit')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='seconds added to every response')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='share of requests answered with 429')
+    parser.add_argument('--rate', type=float, default=1000.0,
+                        help='client rate limit, requests per second')
+    parser.add_argument('--burst', type=int, default=50)
+    parser.add_argument('--backoff', type=float, default=0.05,
+                        help='client backoff base, seconds')
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--index', action='store_true',
+                        help='time the coin index on the fixtures and exit')
+    parser.add_argument('--index-sample', type=int, default=200,
+                        help='pairs timed with the linear scan')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the result as JSON')
+    parser.add_argument('--baseline', help='JSON result to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    if args.generate:
+        asyncio.run(generate(args))
+        return 0
+
+    if args.index:
+        result = index_benchmark(args)
+    else:
+        result = asyncio.run(benchmark(args))
+    for metric, value in result.items():
+        if isinstance(value, float):
+            value = f'{value:.3f}'
+        print(f'{metric:<24}{value}')
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(result, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(result, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,18 @@
+import atexit
+import os
+import shutil
+import tempfile
+
+
+# stakewolle reads its settings on import, point it at a throwaway
+# database before any test module imports it. .env does not override
+# variables that are already set
+_directory = tempfile.mkdtemp(prefix='stakewolle-tests-')
+atexit.register(shutil.rmtree, _directory, ignore_errors=True)
+os.environ['DATABASE_URL'] = (
+    f"sqlite+aiosqlite:///{os.path.join(_directory, 'test.db')}"
+)
+os.environ['DATABASE_REPLICA_URL'] = ''
+os.environ['INVALIDATION_BACKEND'] = 'local'
+os.environ['METRICS_DIR'] = os.path.join(_directory, 'metrics')
+os.environ.setdefault('SECRET_KEY', 'test-secret-key-' + 'x' * 32)
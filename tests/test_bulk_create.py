@@ -0,0 +1,134 @@
+import asyncio
+import datetime
+
+import httpx
+from sqlalchemy import insert, select, update
+
+from stakewolle.app import app
+from stakewolle.cache import referral_cache
+from stakewolle.engine import engine
+from stakewolle.models.models import Base, Referral, ReferralStats, User
+
+
+PASSWORD = 'password'
+
+
+async def _register(client: httpx.AsyncClient, email: str, username: str):
+    response = await client.post('/auth/register', json={
+        'email': email,
+        'username': username,
+        'password': PASSWORD,
+    })
+    response.raise_for_status()
+    return response.json()['id']
+
+
+async def _login(client: httpx.AsyncClient, email: str) -> httpx.Response:
+    return await client.post('/auth/jwt/login', data={
+        'username': email,
+        'password': PASSWORD,
+    })
+
+
+async def _import_users(rows: list[dict]) -> dict:
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+    referral_cache.clear()
+
+    transport = httpx.ASGITransport(app=app)
+    try:
+        async with app.router.lifespan_context(app):
+            async with httpx.AsyncClient(
+                transport=transport,
+                base_url='https://test',
+            ) as client:
+                admin_id = await _register(
+                    client,
+                    'admin@example.com',
+                    'admin',
+                )
+                taken_id = await _register(
+                    client,
+                    'taken@example.com',
+                    'taken',
+                )
+                async with engine.begin() as conn:
+                    await conn.execute(
+                        update(User).
+                        where(User.id == admin_id).
+                        values(is_superuser=True),
+                    )
+                    await conn.execute(insert(Referral).values(
+                        referral='OLD',
+                        user_id=taken_id,
+                        expires_at=datetime.datetime(
+                            2020, 1, 1,
+                            tzinfo=datetime.timezone.utc,
+                        ),
+                    ))
+                (await _login(client, 'admin@example.com')).raise_for_status()
+                (await client.post('/referral/new/', json={
+                    'referral': 'CODE',
+                    'expires_at': (
+                        datetime.datetime.now(datetime.timezone.utc)
+                        + datetime.timedelta(days=1)
+                    ).isoformat(),
+                })).raise_for_status()
+
+                response = await client.post('/users/bulk/', json={
+                    'users': [
+                        {**row, 'password': PASSWORD} for row in rows
+                    ],
+                })
+                response.raise_for_status()
+                login = await _login(client, 'new@example.com')
+
+        async with engine.connect() as conn:
+            stats = (await conn.execute(
+                select(ReferralStats.referrer_id, ReferralStats.total),
+            )).all()
+        return {
+            'response': response.json(),
+            'login_status': login.status_code,
+            'stats': dict(stats),
+            'admin_id': admin_id,
+        }
+    finally:
+        await engine.dispose()
+
+
+def test_bulk_create_reports_every_row():
+    rows = [
+        {'email': 'new@example.com', 'username': 'new', 'referral_name': 'CODE'},  # noqa: E501
+        # Same email as the first row, in another case
+        {'email': 'NEW@example.com', 'username': 'new2'},
+        {'email': 'taken@example.com', 'username': 'other'},
+        {'email': 'nope@example.com', 'username': 'nope', 'referral_name': 'NOPE'},  # noqa: E501
+        {'email': 'old@example.com', 'username': 'old', 'referral_name': 'OLD'},  # noqa: E501
+        # Username of a registered user, caught by the INSERT
+        {'email': 'clash@example.com', 'username': 'taken'},
+        {'email': 'plain@example.com', 'username': 'plain'},
+        # Username of an earlier row
+        {'email': 'again@example.com', 'username': 'plain'},
+    ]
+    result = asyncio.run(_import_users(rows))
+    response = result['response']
+
+    assert [row['status'] for row in response['results']] == [
+        'created',
+        'duplicate',
+        'exists',
+        'invalid_referral',
+        'expired_referral',
+        'exists',
+        'created',
+        'duplicate',
+    ]
+    assert [row['index'] for row in response['results']] == list(range(8))
+    assert response['created'] == 2
+    for row in response['results']:
+        assert (row['id'] is not None) == (row['status'] == 'created')
+    # Passwords are hashed and the referral is counted
+    assert result['login_status'] == 204
+    assert result['stats'] == {result['admin_id']: 1}
@@ -0,0 +1,128 @@
+import asyncio
+import time
+
+from aiohttp import web
+
+from task2 import (
+    AggregatedTicker,
+    BaseExchange,
+    Emit,
+    ExchangeAggregator,
+    RateLimiter,
+    TickerInfo,
+)
+
+
+TIMEOUT = 0.5
+
+
+class FakeExchange(BaseExchange):
+    """
+    Exchange whose /tickers route returns {symbol: [last, base, quote]}.
+    """
+
+    max_retries = 0
+
+    def __init__(self, exchange_id: str, base_url: str):
+        super().__init__()
+        self.id = exchange_id
+        self.base_url = base_url
+        self.rate_limiter = RateLimiter(1000, 10)
+
+    async def _produce_tickers(self, emit: Emit):
+        data = await self.fetch_data(f'{self.base_url}tickers')
+        for symbol, (last, base_volume, quote_volume) in data.items():
+            await emit(symbol, TickerInfo(last, base_volume, quote_volume))
+
+
+async def _serve(handler) -> tuple[web.AppRunner, str]:
+    app = web.Application()
+    app.router.add_get('/tickers', handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    return runner, f'http://{host}:{port}/'
+
+
+async def _fetch_with_slow_and_failing_exchanges():
+    release = asyncio.Event()
+
+    async def healthy(request: web.Request) -> web.Response:
+        return web.json_response({'BTC/USDT': [57000.0, 10.0, 570000.0]})
+
+    async def slow(request: web.Request) -> web.Response:
+        # Answers only when the test is over, long after TIMEOUT
+        await release.wait()
+        return web.json_response({})
+
+    async def failing(request: web.Request) -> web.Response:
+        return web.Response(status=400)
+
+    servers = [
+        await _serve(handler) for handler in (healthy, slow, failing)
+    ]
+    exchanges = [
+        FakeExchange(exchange_id, base_url)
+        for exchange_id, (_, base_url) in zip(
+            ('healthy', 'slow', 'failing'),
+            servers,
+        )
+    ]
+    try:
+        async with ExchangeAggregator(exchanges, timeout=TIMEOUT) as aggregator:  # noqa: E501
+            start = time.monotonic()
+            tickers = await aggregator.fetch_all()
+            seconds = time.monotonic() - start
+            errors = dict(aggregator.errors)
+    finally:
+        release.set()
+        for runner, _ in servers:
+            await runner.cleanup()
+    return tickers, errors, seconds
+
+
+def test_fetch_all_isolates_slow_and_failing_exchanges():
+    tickers, errors, seconds = asyncio.run(
+        _fetch_with_slow_and_failing_exchanges(),
+    )
+
+    assert seconds < TIMEOUT + 0.5
+    assert tickers == {
+        'healthy': {'BTC/USDT': TickerInfo(57000.0, 10.0, 570000.0)},
+    }
+    assert set(errors) == {'slow', 'failing'}
+    assert isinstance(errors['slow'], asyncio.TimeoutError)
+
+
+def test_merge_takes_price_range_and_sums_volumes():
+    merged = ExchangeAggregator.merge({
+        'a': {
+            'BTC/USDT': TickerInfo(57000.0, 10.0, 570000.0),
+            'ETH/USDT': TickerInfo(3000.0, 5.0, 15000.0),
+        },
+        'b': {'BTC/USDT': TickerInfo(56000.0, 2.0, 112000.0)},
+        'c': {'BTC/USDT': TickerInfo(58000.0, 1.0, 58000.0)},
+    })
+
+    assert merged == {
+        'BTC/USDT': AggregatedTicker(
+            low=56000.0,
+            lowExchange='b',
+            high=58000.0,
+            highExchange='c',
+            baseVolume=13.0,
+            quoteVolume=740000.0,
+            exchanges=('a', 'b', 'c'),
+        ),
+        'ETH/USDT': AggregatedTicker(
+            low=3000.0,
+            lowExchange='a',
+            high=3000.0,
+            highExchange='a',
+            baseVolume=5.0,
+            quoteVolume=15000.0,
+            exchanges=('a',),
+        ),
+    }
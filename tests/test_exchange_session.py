@@ -0,0 +1,56 @@
+import asyncio
+
+from aiohttp import web
+
+from task2 import BaseExchange, RateLimiter
+
+
+REQUESTS = 10
+
+
+async def _fetch_through_one_exchange() -> dict:
+    peers = set()
+
+    async def handle(request: web.Request) -> web.Response:
+        # One client port per TCP connection
+        peers.add(request.transport.get_extra_info('peername'))
+        return web.json_response({'path': request.path})
+
+    app = web.Application()
+    app.router.add_get('/{tail:.*}', handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+
+    exchange = BaseExchange()
+    exchange.rate_limiter = RateLimiter(1000, REQUESTS)
+    try:
+        async with exchange:
+            responses = [
+                await exchange.fetch_data(f'http://{host}:{port}/page/{i}')
+                for i in range(REQUESTS)
+            ]
+            session = exchange.session
+        return {
+            'responses': responses,
+            'connections': len(peers),
+            'session': session,
+            'session_after_close': exchange.session,
+        }
+    finally:
+        await runner.cleanup()
+
+
+def test_connections_are_reused_and_released():
+    result = asyncio.run(_fetch_through_one_exchange())
+
+    assert result['responses'] == [
+        {'path': f'/page/{i}'} for i in range(REQUESTS)
+    ]
+    assert result['connections'] < REQUESTS
+    assert result['connections'] == 1
+    assert result['session'].closed
+    assert result['session'].connector is None
+    assert result['session_after_close'] is None
@@ -0,0 +1,138 @@
+import asyncio
+import datetime
+import time
+
+import httpx
+import pytz
+from sqlalchemy import func, select, update
+
+from stakewolle.app import app
+from stakewolle.cache import (
+    CachedReferral,
+    MISSING,
+    ReferralCache,
+    referral_cache,
+)
+from stakewolle.engine import engine
+from stakewolle.models.models import Base, Referral, ReferralStats, User
+
+
+# Lifetime of the referral that expires during the test
+LIFETIME = 1.0
+
+
+def test_cached_referral_is_dropped_when_it_expires():
+    cache = ReferralCache(maxsize=10, ttl=60)
+    now = datetime.datetime.now(pytz.utc)
+    cache.set(
+        CachedReferral('CODE', 1, now + datetime.timedelta(seconds=0.2)),
+        email='referrer@example.com',
+    )
+    cache.set(CachedReferral('OLD', 2, now - datetime.timedelta(seconds=1)))
+
+    assert cache.get_by_code('CODE') == CachedReferral(
+        'CODE',
+        1,
+        now + datetime.timedelta(seconds=0.2),
+    )
+    assert cache.get_by_code('OLD') is MISSING
+    assert cache.get_by_user_id(2) is MISSING
+    time.sleep(0.3)
+    assert cache.get_by_code('CODE') is MISSING
+    assert cache.get_by_email('referrer@example.com') is MISSING
+
+
+async def _register(client: httpx.AsyncClient, email: str, referral_name):
+    return await client.post('/auth/register', json={
+        'email': email,
+        'username': email.split('@')[0],
+        'password': 'password',
+        'referral_name': referral_name,
+    })
+
+
+async def _signups_with_expired_codes() -> dict:
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+    referral_cache.clear()
+
+    try:
+        async with app.router.lifespan_context(app):
+            async with httpx.AsyncClient(
+                transport=httpx.ASGITransport(app=app),
+                base_url='https://test',
+            ) as client:
+                response = await _register(client, 'referrer@example.com', None)  # noqa: E501
+                response.raise_for_status()
+                referrer_id = response.json()['id']
+                (await client.post('/auth/jwt/login', data={
+                    'username': 'referrer@example.com',
+                    'password': 'password',
+                })).raise_for_status()
+                (await client.post('/referral/new/', json={
+                    'referral': 'CODE',
+                    'expires_at': (
+                        datetime.datetime.now(pytz.utc)
+                        + datetime.timedelta(seconds=LIFETIME)
+                    ).isoformat(),
+                })).raise_for_status()
+                # The lookup caches the referral under its code as well
+                (await client.get('/referral/get_by_email/', params={
+                    'email': 'referrer@example.com',
+                })).raise_for_status()
+                warm = referral_cache.get_by_code('CODE')
+
+                await asyncio.sleep(LIFETIME + 0.2)
+                expired = await _register(client, 'late@example.com', 'CODE')
+
+                # A stale cache entry vouching for a referral the
+                # database has since expired
+                async with engine.begin() as conn:
+                    await conn.execute(
+                        update(Referral).
+                        where(Referral.referral == 'CODE').
+                        values(
+                            referral='STALE',
+                            expires_at=datetime.datetime(
+                                2020, 1, 1,
+                                tzinfo=pytz.utc,
+                            ),
+                        ),
+                    )
+                referral_cache.set(CachedReferral(
+                    'STALE',
+                    referrer_id,
+                    datetime.datetime.now(pytz.utc)
+                    + datetime.timedelta(hours=1),
+                ))
+                stale = await _register(client, 'stale@example.com', 'STALE')
+
+        async with engine.connect() as conn:
+            users = (await conn.execute(
+                select(func.count(User.id)),
+            )).scalar_one()
+            counted = (await conn.execute(
+                select(func.count(ReferralStats.referrer_id)),
+            )).scalar_one()
+        return {
+            'warm': warm,
+            'expired': expired,
+            'stale': stale,
+            'users': users,
+            'counted': counted,
+        }
+    finally:
+        await engine.dispose()
+
+
+def test_expired_referral_is_never_approved_from_the_cache():
+    result = asyncio.run(_signups_with_expired_codes())
+
+    assert isinstance(result['warm'], CachedReferral)
+    for response in (result['expired'], result['stale']):
+        assert response.status_code == 400
+        assert response.json()['detail'] == 'Referral was expired'
+    # Only the referrer registered, and no referral was counted
+    assert result['users'] == 1
+    assert result['counted'] == 0
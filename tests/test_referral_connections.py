@@ -0,0 +1,101 @@
+import asyncio
+import datetime
+
+import httpx
+from sqlalchemy import event
+
+from stakewolle.app import app
+from stakewolle.engine import engine
+from stakewolle.models.models import Base
+
+
+class CheckoutCounter:
+    """
+    Pooled connections checked out at once, and the most of them
+    since the last reset.
+    """
+
+    def __init__(self):
+        self.current = 0
+        self.max = 0
+
+    def checkout(self, *args):
+        self.current += 1
+        self.max = max(self.max, self.current)
+
+    def checkin(self, *args):
+        self.current -= 1
+
+    def reset(self):
+        self.max = self.current
+
+
+async def _connections_per_request() -> dict:
+    """
+    :return: Endpoint -> most connections it held at once.
+    """
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+
+    counter = CheckoutCounter()
+    event.listen(engine.sync_engine, 'checkout', counter.checkout)
+    event.listen(engine.sync_engine, 'checkin', counter.checkin)
+    transport = httpx.ASGITransport(app=app)
+    try:
+        async with app.router.lifespan_context(app):
+            async with httpx.AsyncClient(
+                transport=transport,
+                base_url='https://test',
+            ) as client:
+                credentials = {
+                    'email': 'referrer@example.com',
+                    'password': 'password',
+                }
+                (await client.post('/auth/register', json={
+                    **credentials,
+                    'username': 'referrer',
+                })).raise_for_status()
+                (await client.post('/auth/jwt/login', data={
+                    'username': credentials['email'],
+                    'password': credentials['password'],
+                })).raise_for_status()
+
+                expires_at = (
+                    datetime.datetime.now(datetime.timezone.utc)
+                    + datetime.timedelta(days=1)
+                )
+                requests = [
+                    ('/referral/new/', lambda: client.post(
+                        '/referral/new/',
+                        json={
+                            'referral': 'CODE',
+                            'expires_at': expires_at.isoformat(),
+                        },
+                    )),
+                    ('/referral/get_my_referral/', lambda: client.get(
+                        '/referral/get_my_referral/',
+                    )),
+                    ('/referral/delete/', lambda: client.delete(
+                        '/referral/delete/',
+                    )),
+                    ('/', lambda: client.get('/')),
+                ]
+                connections = {}
+                for endpoint, send in requests:
+                    counter.reset()
+                    response = await send()
+                    assert response.is_success, (endpoint, response.text)
+                    connections[endpoint] = counter.max
+                return connections
+    finally:
+        event.remove(engine.sync_engine, 'checkout', counter.checkout)
+        event.remove(engine.sync_engine, 'checkin', counter.checkin)
+        await engine.dispose()
+
+
+def test_authenticated_requests_hold_one_connection():
+    connections = asyncio.run(_connections_per_request())
+    assert len(connections) == 4
+    for endpoint, count in connections.items():
+        assert count <= 1, f'{endpoint} held {count} connections at once'
@@ -0,0 +1,122 @@
+import asyncio
+import datetime
+
+import httpx
+import pytz
+from sqlalchemy import insert, select
+
+from stakewolle.app import app
+from stakewolle.cache import referral_cache
+from stakewolle.engine import async_session_maker, engine
+from stakewolle.models.models import (
+    Base,
+    Referral,
+    ReferralStats,
+    ReferralStatsHourly,
+    User,
+)
+from stakewolle.referral_stats import count_referrals, rebuild
+
+
+async def _snapshot(conn) -> tuple[set, set]:
+    totals = await conn.execute(select(
+        ReferralStats.referrer_id,
+        ReferralStats.total,
+        ReferralStats.last_signup_at,
+    ))
+    buckets = await conn.execute(select(
+        ReferralStatsHourly.referrer_id,
+        ReferralStatsHourly.hour,
+        ReferralStatsHourly.count,
+    ))
+    return set(totals.all()), set(buckets.all())
+
+
+async def _incremental_and_rebuilt_stats(now: datetime.datetime):
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+    referral_cache.clear()
+
+    # Referred users registered over the last week, hours apart or in
+    # the same hour
+    ages = {
+        'ALICE': [
+            datetime.timedelta(minutes=1),
+            datetime.timedelta(hours=2, minutes=5),
+            datetime.timedelta(hours=2, minutes=10),
+            datetime.timedelta(days=3),
+        ],
+        'BOB': [
+            datetime.timedelta(minutes=30),
+            datetime.timedelta(days=6, hours=23),
+        ],
+    }
+    try:
+        async with async_session_maker() as session:
+            signups = []
+            for number, code in enumerate(ages, 1):
+                session.add(User(
+                    email=f'referrer{number}@example.com',
+                    username=f'referrer{number}',
+                    hashed_password='-',
+                ))
+                await session.flush()
+                referrer_id = (await session.execute(
+                    select(User.id).
+                    where(User.username == f'referrer{number}'),
+                )).scalar_one()
+                await session.execute(insert(Referral).values(
+                    referral=code,
+                    user_id=referrer_id,
+                    expires_at=now + datetime.timedelta(days=1),
+                ))
+                for index, age in enumerate(ages[code]):
+                    session.add(User(
+                        email=f'{code.lower()}{index}@example.com',
+                        username=f'{code.lower()}{index}',
+                        hashed_password='-',
+                        referral_name=code,
+                        registered_at=now - age,
+                    ))
+                    signups.append((referrer_id, now - age))
+            # Not referred, counted by neither
+            session.add(User(
+                email='alone@example.com',
+                username='alone',
+                hashed_password='-',
+                registered_at=now,
+            ))
+            await count_referrals(session, signups)
+            await session.commit()
+
+        # And one registration through the API
+        async with app.router.lifespan_context(app):
+            async with httpx.AsyncClient(
+                transport=httpx.ASGITransport(app=app),
+                base_url='https://test',
+            ) as client:
+                (await client.post('/auth/register', json={
+                    'email': 'signup@example.com',
+                    'username': 'signup',
+                    'password': 'password',
+                    'referral_name': 'BOB',
+                })).raise_for_status()
+
+        async with engine.begin() as conn:
+            incremental = await _snapshot(conn)
+            await rebuild(conn, now)
+            rebuilt = await _snapshot(conn)
+        return incremental, rebuilt
+    finally:
+        await engine.dispose()
+
+
+def test_rebuild_matches_incremental_counters():
+    now = datetime.datetime.now(pytz.utc)
+    incremental, rebuilt = asyncio.run(_incremental_and_rebuilt_stats(now))
+    totals, buckets = incremental
+
+    assert sorted(total for _, total, _ in totals) == [3, 4]
+    assert sum(count for _, _, count in buckets) == 7
+    assert rebuilt == incremental